@@ -15,11 +15,13 @@ from channels.security.websocket import AllowedHostsOriginValidator
 from channels.sessions import SessionMiddlewareStack
 from django.core.asgi import get_asgi_application
 import main.routing
+from main.lifespan import LifespanApp
 from main.middleware import WebSocketMiddleware
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatbot.settings')
 
 application = ProtocolTypeRouter({
+    'lifespan': LifespanApp(),
     'http': get_asgi_application(),
     'websocket': AllowedHostsOriginValidator(AuthMiddlewareStack(SessionMiddlewareStack(WebSocketMiddleware(
         URLRouter(
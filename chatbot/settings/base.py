@@ -148,6 +148,45 @@ DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Number of chunks given to the model as context for a question
+RETRIEVER_K = int(os.environ.get('RETRIEVER_K', 3))
+# Most tokens of them to put in the prompt, after merging overlapping chunks and dropping repeated lines
+CONTEXT_MAX_TOKENS = int(os.environ.get('CONTEXT_MAX_TOKENS', 1500))
+# Seconds to wait after a document changes before rebuilding the knowledge base, so a batch of changes makes one rebuild
+REBUILD_DELAY = int(os.environ.get('REBUILD_DELAY', 10))
+
+# Maximum number of questions a single worker sends to OpenAI at once, and how long each may take (in seconds)
+GENIE_MAX_CONCURRENCY = int(os.environ.get('GENIE_MAX_CONCURRENCY', 20))
+GENIE_TIMEOUT = int(os.environ.get('GENIE_TIMEOUT', 60))
+
+# Answers are reused for the same normalised question, or for one whose embedding is at least this similar
+ANSWER_CACHE_TTL = int(os.environ.get('ANSWER_CACHE_TTL', 24 * 60 * 60))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', 1000))
+ANSWER_CACHE_SIMILARITY = float(os.environ.get('ANSWER_CACHE_SIMILARITY', 0.95))
+# How long (in seconds) embeddings of questions are kept in Redis
+EMBEDDING_CACHE_TTL = int(os.environ.get('EMBEDDING_CACHE_TTL', 7 * 24 * 60 * 60))
+
+# Residency galleries are scraped in the background, and re-scraped once they are older than GALLERY_MAX_AGE_DAYS
+GALLERY_SCRAPER_CONCURRENCY = int(os.environ.get('GALLERY_SCRAPER_CONCURRENCY', 8))
+GALLERY_SCRAPER_PER_HOST = int(os.environ.get('GALLERY_SCRAPER_PER_HOST', 2))
+GALLERY_REFRESH_INTERVAL = int(os.environ.get('GALLERY_REFRESH_INTERVAL', 60))
+GALLERY_STALE_CHECK_INTERVAL = int(os.environ.get('GALLERY_STALE_CHECK_INTERVAL', 60 * 60))
+GALLERY_MAX_AGE_DAYS = int(os.environ.get('GALLERY_MAX_AGE_DAYS', 7))
+
+# Monthly OpenAI spend cap in USD (0 for none). Past the economy ratio of it questions get a smaller context,
+# and past the cache-only ratio only questions answered before are answered
+MONTHLY_BUDGET_USD = float(os.environ.get('MONTHLY_BUDGET_USD', 0))
+BUDGET_ECONOMY_RATIO = float(os.environ.get('BUDGET_ECONOMY_RATIO', 0.8))
+BUDGET_CACHE_ONLY_RATIO = float(os.environ.get('BUDGET_CACHE_ONLY_RATIO', 0.95))
+BUDGET_ECONOMY_CHUNKS = int(os.environ.get('BUDGET_ECONOMY_CHUNKS', 2))
+
+# Questions OpenAI accepts per minute. Past it (or the token limit) questions wait in a queue, for up to ADMISSION_TIMEOUT seconds
+OPENAI_RPM = int(os.environ.get('OPENAI_RPM', 25))
+ADMISSION_TIMEOUT = int(os.environ.get('ADMISSION_TIMEOUT', 120))
+
+# Events for the panel are sent in batches, collected over this many seconds
+PANEL_BATCH_WINDOW = float(os.environ.get('PANEL_BATCH_WINDOW', 0.1))
+
 HOSTNAME = os.environ.get('HOSTNAME')
 IS_HTTPS = literal_eval(os.environ.get('IS_HTTPS'))
 URL = ('https://' if IS_HTTPS else 'http://') + HOSTNAME
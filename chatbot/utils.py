@@ -1,9 +1,21 @@
-import json
-from datetime import datetime
+import re
+import unicodedata
 
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, datetime):
-            return o.isoformat()
 
-        return super().default(o)
+# Cyrillic letters are mapped to their Latin spelling with diacritics, which fold_text then strips,
+# so "прашање", "prašanje" and "prasanje" all end up the same
+CYRILLIC_TO_LATIN = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'ђ': 'đ', 'ѓ': 'đ', 'е': 'e', 'ж': 'ž', 'з': 'z',
+    'ѕ': 'dz', 'и': 'i', 'ј': 'j', 'к': 'k', 'л': 'l', 'љ': 'lj', 'м': 'm', 'н': 'n', 'њ': 'nj', 'о': 'o',
+    'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'ћ': 'ć', 'ќ': 'ć', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'c',
+    'ч': 'č', 'џ': 'dž', 'ш': 'š',
+})
+
+
+def fold_text(text):
+    text = unicodedata.normalize('NFKD', text.lower().translate(CYRILLIC_TO_LATIN).replace('đ', 'dj'))
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+
+def normalize_question(text):
+    return ' '.join(re.findall(r'\w+', fold_text(text)))
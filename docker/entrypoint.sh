@@ -4,5 +4,8 @@ echo "Running migrations..."
 ./docker/wait-for-postgres.sh db "python manage.py makemigrations --merge --noinput"
 python manage.py migrate --noinput
 
+echo "Collecting static files..."
+python manage.py collectstatic --noinput
+
 echo "Starting the Django application..."
 "$@"
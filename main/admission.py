@@ -0,0 +1,266 @@
+import asyncio
+import json
+import math
+import time
+import traceback
+from uuid import uuid4
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .costs import budget_limit_micros, cost_micros, spend_keys
+from .redis_init import (
+    GLOBAL_TOKEN_LIMIT_PER_MINUTE, RATE_LIMITED, RESERVED, TOKEN_LIMIT_KEYS, async_redis_conn, blocking_redis_conn,
+    message_limit_script, token_limit_script,
+)
+
+REQUESTS_KEY = 'openai:requests'
+RING_KEY = 'admission:ring'
+QUEUE_KEY = 'admission:queue:%s'
+TICKET_KEY = 'admission:ticket:%s'
+TICKETS_KEY = 'admission:tickets'
+WAKE_KEY = 'admission:wake'
+LEADER_KEY = 'admission:leader'
+LEADER_TIMEOUT = 10
+# Consumers give up on a ticket after ADMISSION_TIMEOUT, so anything older was left behind by one that's gone
+TICKET_TIMEOUT = settings.ADMISSION_TIMEOUT + LEADER_TIMEOUT
+
+# Queues a ticket behind the visitor's earlier ones, puts the visitor in the ring if they had none and wakes
+# the leader. Everything expires once no tickets have come in for a while, in case no worker is left to drain it.
+enqueue_script = async_redis_conn.register_script("""
+redis.call('SET', KEYS[4], ARGV[3], 'EX', ARGV[4])
+redis.call('ZADD', KEYS[3], redis.call('TIME')[1], ARGV[2])
+if redis.call('RPUSH', KEYS[2], ARGV[2]) == 1 then
+  redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+for i = 1, 3 do
+  redis.call('EXPIRE', KEYS[i], ARGV[4])
+end
+redis.call('RPUSH', KEYS[5], 1)
+redis.call('LTRIM', KEYS[5], 0, 0)
+redis.call('EXPIRE', KEYS[5], ARGV[4])
+return redis.call('ZCARD', KEYS[3])
+""")
+
+# Wakes the leader if anything is queued, keeping at most one wake-up pending
+wake_script = async_redis_conn.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  redis.call('RPUSH', KEYS[2], 1)
+  redis.call('LTRIM', KEYS[2], 0, 0)
+  redis.call('EXPIRE', KEYS[2], ARGV[1])
+end
+""")
+
+# Takes the ticket off the head of the queue if it's still there, and moves its visitor to the back of the ring
+pop_script = async_redis_conn.register_script("""
+if redis.call('LINDEX', KEYS[1], 0) ~= ARGV[1] or redis.call('LINDEX', KEYS[2], 0) ~= ARGV[2] then
+  return 0
+end
+redis.call('LPOP', KEYS[1])
+redis.call('LPOP', KEYS[2])
+redis.call('ZREM', KEYS[3], ARGV[2])
+redis.call('DEL', KEYS[4])
+if redis.call('LLEN', KEYS[2]) > 0 then
+  redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+return 1
+""")
+
+# Withdraws a ticket, e.g. because its visitor left
+cancel_script = async_redis_conn.register_script("""
+local removed = redis.call('LREM', KEYS[2], 0, ARGV[2])
+redis.call('ZREM', KEYS[3], ARGV[2])
+redis.call('DEL', KEYS[4])
+if redis.call('LLEN', KEYS[2]) == 0 then
+  redis.call('LREM', KEYS[1], 0, ARGV[1])
+end
+return removed
+""")
+
+leader_script = async_redis_conn.register_script("""
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) or redis.call('GET', KEYS[1]) == ARGV[1] then
+  redis.call('EXPIRE', KEYS[1], ARGV[2])
+  return 1
+end
+return 0
+""")
+
+resign_script = async_redis_conn.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  redis.call('DEL', KEYS[1])
+end
+""")
+
+
+async def reserve(tokens, cost):
+    """
+    Takes a request from the per-minute request limit and reserves its tokens from the token limit (if the
+    monthly budget allows for their cost). Returns the status, the seconds until there's room if there
+    isn't, and the reservation, which is needed to reconcile or release it.
+    """
+    request = uuid4().hex
+    requests, remaining_secs = await message_limit_script(keys=[REQUESTS_KEY], args=['true', settings.OPENAI_RPM, 60, request])
+    if requests >= settings.OPENAI_RPM:
+        return RATE_LIMITED, max(remaining_secs, 1), None
+    status, bucket, remaining_secs, spent = await token_limit_script(
+        keys=TOKEN_LIMIT_KEYS + spend_keys(), args=['reserve', tokens, GLOBAL_TOKEN_LIMIT_PER_MINUTE, cost, budget_limit_micros()]
+    )
+    if status != RESERVED:
+        await async_redis_conn.zrem(REQUESTS_KEY, request)
+        return status, max(remaining_secs, 1), None
+    return status, 0, {'request': request, 'bucket': bucket, 'tokens': tokens, 'spent': spent}
+
+
+async def reconcile(reservation, model, prompt_tokens, completion_tokens):
+    await token_limit_script(
+        keys=TOKEN_LIMIT_KEYS + spend_keys(),
+        args=['reconcile', prompt_tokens + completion_tokens, GLOBAL_TOKEN_LIMIT_PER_MINUTE,
+              cost_micros(model, prompt_tokens, completion_tokens) if prompt_tokens else 0, 0,
+              reservation['bucket'], reservation['tokens']],
+    )
+    # The tokens reserved but not used may be what a queued ticket is waiting for
+    await wake_script(keys=[RING_KEY, WAKE_KEY], args=[TICKET_TIMEOUT])
+
+
+async def release(reservation):
+    await async_redis_conn.zrem(REQUESTS_KEY, reservation['request'])
+    await reconcile(reservation, None, 0, 0)
+
+
+class AdmissionQueue:
+    """
+    Lets questions through to OpenAI at the rate it allows. A question that doesn't fit (or would jump
+    ahead of queued ones) gets a ticket in the Redis queue of its visitor's IP, and one worker at a time
+    admits tickets round robin over the visitors, so one of them can't keep the others waiting. Consumers
+    hear about their ticket's position and admission through the channel layer.
+    """
+
+    def __init__(self):
+        self.id = uuid4().hex
+        self.worker = None
+        self.positions = {}
+        # Tickets queued by this process, so the worker doesn't stop while one of them is on its way in
+        self.queued = 0
+
+    @staticmethod
+    def keys(ip, ticket):
+        return [RING_KEY, QUEUE_KEY % ip, TICKETS_KEY, TICKET_KEY % ticket]
+
+    async def admit(self, ip, channel, tokens, cost):
+        """Admits the question right away if nobody is queued and there's room. Otherwise returns a ticket and its position."""
+        if not await async_redis_conn.exists(RING_KEY):
+            status, _, reservation = await reserve(tokens, cost)
+            if status != RATE_LIMITED:
+                return status, reservation, None, None
+        ticket = uuid4().hex
+        position = await enqueue_script(
+            keys=self.keys(ip, ticket) + [WAKE_KEY],
+            args=[ip, ticket, json.dumps({'channel': channel, 'tokens': tokens, 'cost': cost}), TICKET_TIMEOUT],
+        )
+        self.queued += 1
+        self.ensure_worker()
+        return None, None, ticket, position
+
+    async def cancel(self, ip, ticket):
+        return await cancel_script(keys=self.keys(ip, ticket), args=[ip, ticket])
+
+    def ensure_worker(self):
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+
+    async def run(self):
+        """
+        Runs while anything is queued. The leader admits tickets and then sleeps until a ticket comes in, tokens
+        are released or there should be room again, the others only check in now and then to take over if it's gone.
+        """
+        while True:
+            queued = self.queued
+            try:
+                if not await async_redis_conn.exists(RING_KEY):
+                    await resign_script(keys=[LEADER_KEY], args=[self.id])
+                    self.positions = {}
+                    # Unless a ticket was queued meanwhile, which may have found this worker still running
+                    if self.queued == queued and not await async_redis_conn.exists(RING_KEY):
+                        return
+                    continue
+                if await leader_script(keys=[LEADER_KEY], args=[self.id, LEADER_TIMEOUT]):
+                    delay = await self.drain() or LEADER_TIMEOUT / 2
+                    if not await async_redis_conn.exists(RING_KEY):
+                        continue
+                    await blocking_redis_conn.blpop(WAKE_KEY, timeout=max(1, math.ceil(min(delay, LEADER_TIMEOUT / 2))))
+                else:
+                    self.positions = {}
+                    await asyncio.sleep(LEADER_TIMEOUT / 2)
+            except Exception:
+                traceback.print_exc()
+                await asyncio.sleep(1)
+
+    async def prune(self):
+        """Forgets tickets older than any consumer waits for. Their queue entries go once they reach the head."""
+        await async_redis_conn.zremrangebyscore(TICKETS_KEY, '-inf', time.time() - TICKET_TIMEOUT)
+
+    async def drain(self):
+        """Admits tickets until there's no room left. Returns how long to wait for some, if that's why it stopped."""
+        channel_layer = get_channel_layer()
+        await self.prune()
+        delay = None
+        while True:
+            ip = await async_redis_conn.lindex(RING_KEY, 0)
+            if ip is None:
+                break
+            ip = ip.decode()
+            ticket = await async_redis_conn.lindex(QUEUE_KEY % ip, 0)
+            if ticket is None:
+                await async_redis_conn.lrem(RING_KEY, 0, ip)
+                continue
+            ticket = ticket.decode()
+            data = await async_redis_conn.get(TICKET_KEY % ticket)
+            if data is None:
+                # Expired, its consumer is long gone
+                await self.cancel(ip, ticket)
+                continue
+            data = json.loads(data)
+            status, remaining_secs, reservation = await reserve(data['tokens'], data['cost'])
+            if status == RATE_LIMITED:
+                delay = remaining_secs
+                break
+            if not await pop_script(keys=self.keys(ip, ticket), args=[ip, ticket]):
+                if reservation:
+                    await release(reservation)
+                continue
+            await channel_layer.send(data['channel'], {
+                'type': 'admission.admitted', 'ticket': ticket, 'status': status, 'reservation': reservation,
+            })
+        await self.send_positions(channel_layer)
+        return delay
+
+    async def send_positions(self, channel_layer):
+        """Tells every queued ticket how many questions are ahead of it, if that changed."""
+        ips = [ip.decode() for ip in await async_redis_conn.lrange(RING_KEY, 0, -1)]
+        async with async_redis_conn.pipeline(transaction=False) as pipe:
+            for ip in ips:
+                pipe.lrange(QUEUE_KEY % ip, 0, -1)
+            queues = [[ticket.decode() for ticket in queue] for queue in await pipe.execute()]
+        queued = [ticket for queue in queues for ticket in queue]
+        data = await async_redis_conn.mget([TICKET_KEY % ticket for ticket in queued]) if queued else []
+        tickets = {ticket: json.loads(ticket_data) for ticket, ticket_data in zip(queued, data) if ticket_data is not None}
+
+        positions = {}
+        for r, queue in enumerate(queues):
+            for k, ticket in enumerate(queue):
+                # Admitted round robin: the first k tickets of every visitor go first, then the visitors ahead in the ring
+                positions[ticket] = sum(min(len(other), k) for other in queues) + \
+                    sum(1 for other in queues[:r] if len(other) > k) + 1
+        for ticket, position in positions.items():
+            if self.positions.get(ticket) != position and ticket in tickets:
+                await channel_layer.send(tickets[ticket]['channel'], {
+                    'type': 'admission.position', 'ticket': ticket, 'position': position,
+                })
+        self.positions = positions
+
+
+admission_queue = AdmissionQueue()
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import time
+import traceback
+
+import numpy as np
+from django.conf import settings
+
+from chatbot.utils import normalize_question
+from .embeddings import CachedEmbeddings
+from .redis_init import async_redis_conn
+from .schema import CustomResponseSchema
+
+PREFIX = 'answer_cache'
+# Mirrors of the vectors kept locally, the current version's and the previous one's for questions still on it
+MIRRORED_VERSIONS = 2
+
+
+def key(version, *parts):
+    return ':'.join((PREFIX, version) + parts)
+
+
+class VectorMirror:
+    """The embeddings of the questions cached under one index version, mirrored from its Redis stream."""
+
+    def __init__(self, version):
+        self.version = version
+        self.reset()
+
+    def reset(self):
+        self.vectors = {}
+        self.names = {}
+        self.last_stream_id = None
+        self.digests = None
+        self.matrix = None
+
+    async def sync(self):
+        if len(self.vectors) > settings.ANSWER_CACHE_MAX_ENTRIES * 2:
+            # Drop entries evicted elsewhere by starting over from the (trimmed) stream
+            self.reset()
+        entries = await async_redis_conn.xrange(
+            key(self.version, 'vectors'), min=f'({self.last_stream_id}' if self.last_stream_id else '-'
+        )
+        for stream_id, fields in entries:
+            digest = fields[b'digest'].decode()
+            self.vectors[digest] = np.frombuffer(fields[b'vector'], dtype=np.float32)
+            self.names[digest] = fields.get(b'names', b'').decode()
+            self.last_stream_id = stream_id.decode()
+        if entries:
+            self.matrix = None
+
+    def most_similar(self, embedding, names):
+        """The digest of the most similar question naming the same residencies, if it's similar enough."""
+        if not self.vectors:
+            return None
+        if self.matrix is None:
+            self.digests = list(self.vectors)
+            self.matrix = np.stack([self.vectors[digest] for digest in self.digests])
+        # Vectors are stored normalised, so the dot product is the cosine similarity
+        scores = self.matrix @ embedding
+        similar = [i for i in np.flatnonzero(scores >= settings.ANSWER_CACHE_SIMILARITY) if self.names[self.digests[i]] == names]
+        if not similar:
+            return None
+        return self.digests[max(similar, key=lambda i: scores[i])]
+
+    def forget(self, digest):
+        if self.vectors.pop(digest, None) is not None:
+            del self.names[digest]
+            self.matrix = None
+
+
+class AnswerCache:
+    """
+    Answers shared by all workers through Redis. Exact hits are looked up by the normalised question,
+    the rest by cosine similarity against embeddings of cached questions naming the same residencies, which
+    every process mirrors locally from a Redis stream. Entries live under the index version the question was
+    answered on, so rebuilding the index leaves them behind (to expire), while questions still answered on
+    the previous version keep using theirs.
+    """
+
+    def __init__(self):
+        self.embeddings = None
+        self.mirrors = {}
+
+    def mirror(self, version):
+        if version not in self.mirrors:
+            self.mirrors[version] = VectorMirror(version)
+            while len(self.mirrors) > MIRRORED_VERSIONS:
+                del self.mirrors[next(iter(self.mirrors))]
+        return self.mirrors[version]
+
+    @staticmethod
+    def names_key(names):
+        return ','.join(sorted(names))
+
+    async def get(self, version, question, names=()):
+        """
+        Returns the response cached under the index version (or None) and the question's embedding, if it had
+        to be computed. A similar question only counts if it names the same residencies (names), as the
+        embeddings barely tell them apart.
+        """
+        response = await self.fetch(version, self.digest(question))
+        if response is not None:
+            return response, None
+        try:
+            if self.embeddings is None:
+                self.embeddings = CachedEmbeddings()
+            embedding = np.asarray(await self.embeddings.aembed_query(question), dtype=np.float32)
+        except Exception:
+            traceback.print_exc()
+            return None, None
+        embedding /= np.linalg.norm(embedding)
+        return await self.find_similar(version, embedding, self.names_key(names)), embedding
+
+    async def set(self, version, question, response, tokens, embedding=None, names=()):
+        digest = self.digest(question)
+        now = time.time()
+        async with async_redis_conn.pipeline(transaction=True) as pipe:
+            pipe.set(key(version, 'answer', digest), json.dumps({'response': response.dict(), 'tokens': tokens}), ex=settings.ANSWER_CACHE_TTL)
+            pipe.zadd(key(version, 'lru'), {digest: now})
+            pipe.zremrangebyscore(key(version, 'lru'), '-inf', now - settings.ANSWER_CACHE_TTL)
+            pipe.expire(key(version, 'lru'), settings.ANSWER_CACHE_TTL)
+            if embedding is not None:
+                pipe.xadd(key(version, 'vectors'), {'digest': digest, 'vector': embedding.tobytes(), 'names': self.names_key(names)},
+                          maxlen=settings.ANSWER_CACHE_MAX_ENTRIES * 2, approximate=True)
+                pipe.expire(key(version, 'vectors'), settings.ANSWER_CACHE_TTL)
+            pipe.zcard(key(version, 'lru'))
+            entries = (await pipe.execute())[-1]
+        if entries > settings.ANSWER_CACHE_MAX_ENTRIES:
+            # Evict the least recently used answers
+            evicted = await async_redis_conn.zpopmin(key(version, 'lru'), entries - settings.ANSWER_CACHE_MAX_ENTRIES)
+            await async_redis_conn.delete(*(key(version, 'answer', digest.decode()) for digest, _ in evicted))
+
+    @staticmethod
+    def digest(question):
+        return hashlib.sha1(normalize_question(question).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    async def fetch(version, digest):
+        data = await async_redis_conn.get(key(version, 'answer', digest))
+        if data is None:
+            return None
+        data = json.loads(data)
+        async with async_redis_conn.pipeline(transaction=False) as pipe:
+            pipe.zadd(key(version, 'lru'), {digest: time.time()})
+            pipe.incrby(f'{PREFIX}:tokens_saved', data['tokens'])
+            await pipe.execute()
+        print(f"Answer cache hit, {data['tokens']} tokens saved")
+        return CustomResponseSchema(**data['response'])
+
+    async def find_similar(self, version, embedding, names):
+        mirror = self.mirror(version)
+        await mirror.sync()
+        digest = mirror.most_similar(embedding, names)
+        if digest is None:
+            return None
+        response = await self.fetch(version, digest)
+        if response is None:
+            # Evicted or expired in the meantime
+            mirror.forget(digest)
+        return response
+
+
+answer_cache = AnswerCache()
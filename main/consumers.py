@@ -1,185 +1,227 @@
-import json
-from collections import Counter
+import asyncio
+import traceback
 from datetime import datetime, timedelta
+from uuid import uuid4
 
-from asgiref.sync import async_to_sync
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.layers import get_channel_layer
-from django.db.models import F
+from django.conf import settings
+from django.db.models import F, Q
 from django.utils import timezone
-from nltk import ngrams
-
-from .redis_init import lua_script
-from chatbot.utils import DateTimeEncoder
-from .genie import Genie
-
-
-contact_keywords = 'kontaktiram kontaktiraj kontakt kontaktirajte kontaktira'\
-                   ' zboruvam zboruvaj zboruvanje zboruvajte zboruva'\
-                   ' tipkam tipkaj tipkanje tipkajte tipka'\
-                   ' pisuvam pisuvaj pisuvanje pisuvajte pisuva' \
-                   ' pišuvam pišuvaj pišuvanje pišuvajte pišuva'\
-                   ' prasam prasaj prasanje prasajte prasa'\
-                   ' prašam prašaj prašanje prašajte praša'\
-                   ' контактирам контактирај контакт контактирајте контактира'\
-                   ' зборувам зборувај зборување зборувајте зборува'\
-                   ' типкам типкај типкање типкајте типка'\
-                   ' пишувам пишувај пишување пишувајте пишува'\
-                   ' прашам прашај прашање прашајте праша'.split(' ')
-agent_keywords = 'agenta agent agenti agentom'\
-                 ' operator operatori operatorot'\
-                 ' covek covekot čovek čovekot'\
-                 ' агента агент агенти агентом'\
-                 ' оператор оператори операторот'\
-                 ' човек човекот'.split(' ')
-
-def calculate_trigram_similarity(message, keywords_list):
-    scores = []
-    for keyword in keywords_list:
-        trigrams_message = Counter(ngrams(message, 3))
-        trigrams_keyword = Counter(ngrams(keyword, 3))
-
-        intersection = trigrams_message & trigrams_keyword
-        union = trigrams_message | trigrams_keyword
-
-        if sum(union.values()) != 0:
-            scores.append(sum(intersection.values()) / sum(union.values()))
-    return max(scores)
+
+from .cache import answer_cache
+from .admission import admission_queue, reconcile, release
+from .costs import ECONOMY, cost_micros, spend_mode
+from .redis_init import OVER_BUDGET, RATE_LIMITED, async_redis_conn, message_limit_script
+from .genie import BUDGET_ANSWER, ERROR_ANSWER, MODEL_NAME, WARMING_ANSWER, Genie
+from .intents import intent_matcher
+from .panel_events import SUMMARY_GROUP, group_for, panel_event_bus
+from .serialization import dumps, loads, negotiate
 
 
 MESSAGE_LIMIT_PER_IP = 5
 TIME_LIMIT_PER_IP = timedelta(hours=1)
+PANEL_PAGE_SIZE = 50
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        from .models import Document
-        self.genie = await database_sync_to_async(Genie)(Document.objects.all())
+        if Genie.state in (Genie.COLD, Genie.FAILED):
+            # Normally already started by the lifespan handler
+            Genie.start_warm_up()
         self.session = None
         self.group_name = None
+        # Background work of this socket, kept referenced until it's done so it isn't garbage collected
+        self.tasks = set()
+        self.admission = None
         await self.accept()
         await self.handle_exceeded_msg_limit()
 
     async def disconnect(self, close_code):
+        for task in self.tasks:
+            # Nobody is left to read the answers, so stop waiting on OpenAI for them
+            task.cancel()
         await self.close_session()
         if self.group_name:
             await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
-    @database_sync_to_async
-    def close_session(self):
+    async def close_session(self):
+        from .models import ChatSession
         if self.session:
-            self.session.refresh_from_db()
-            self.session.is_terminated = True
-            self.session.save()
+            await ChatSession.objects.filter(pk=self.session.pk).aupdate(is_terminated=True)
 
-    @staticmethod
-    async def get_global_token_limit(tokens=0, update=True):
-        remaining_secs = lua_script(args=[str(update).lower(), tokens])
-        if remaining_secs > 0:
-            return True, remaining_secs
-        return False, 0
+    def run_in_background(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
 
-    @database_sync_to_async
-    def get_message_limit(self):
-        from .models import UserIP, ChatMessage
-        user_ip, created = UserIP.objects.get_or_create(ip_address=self.scope['client_ip'])
-        message_count = 0
-        remaining_secs = 0
-        if not created:
-            one_hour_ago = timezone.now() - TIME_LIMIT_PER_IP
-            message_count = ChatMessage.objects.filter(
-                session__in=user_ip.chat_sessions.all(),
-                session__is_human_intercepted=False,
-                session__agent_requested=False,
-                created_at__gte=one_hour_ago
-            ).count()
-            if user_ip.latest_message_time:
-                remaining_secs = max(0, int((user_ip.latest_message_time + TIME_LIMIT_PER_IP - timezone.now()).total_seconds()))
-        return message_count, user_ip, remaining_secs
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            traceback.print_exception(task.exception())
 
-    @database_sync_to_async
-    def update_last_message_time(self, user_ip):
-        user_ip.latest_message_time = timezone.now()
-        user_ip.save()
+    def message_limit_key(self):
+        return f"messages:{self.scope['client_ip']}"
+
+    async def get_message_limit(self, record=False, member=None):
+        message_count, remaining_secs = await message_limit_script(
+            keys=[self.message_limit_key()],
+            args=[str(record).lower(), MESSAGE_LIMIT_PER_IP, int(TIME_LIMIT_PER_IP.total_seconds()), member or ''],
+        )
+        return message_count, remaining_secs
 
-    async def handle_exceeded_msg_limit(self, message_count=None, user_ip=None, remaining_secs=None, update_time=False):
-        if not user_ip:
-            message_count, user_ip, remaining_secs = await self.get_message_limit()
+    async def update_last_message_time(self):
+        # Only kept for auditing, the limit itself is enforced in Redis
+        from .models import UserIP
+        await UserIP.objects.aupdate_or_create(ip_address=self.scope['client_ip'], defaults={'latest_message_time': timezone.now()})
+
+    async def forget_message(self, member):
+        # The message went unanswered, so it doesn't count towards the visitor's limit
+        await async_redis_conn.zrem(self.message_limit_key(), member)
+
+    async def handle_exceeded_msg_limit(self, record=False):
+        member = uuid4().hex
+        message_count, remaining_secs = await self.get_message_limit(record, member)
         is_exceeded = False
         if message_count >= MESSAGE_LIMIT_PER_IP:
             is_exceeded = True
-        if update_time:
-            await self.update_last_message_time(user_ip)
-        global_limit = False
-        if not is_exceeded:
-            is_exceeded, remaining_secs = await self.get_global_token_limit(update=False)
-            if is_exceeded:
-                global_limit = True
+        elif record:
+            self.run_in_background(self.update_last_message_time())
         if is_exceeded:
-            await self.send(text_data=json.dumps({'exceeded_limit': True, 'remaining_secs': remaining_secs, 'global_limit': global_limit}))
-        return is_exceeded, message_count, user_ip, remaining_secs
+            await self.send(text_data=dumps({'exceeded_limit': True, 'remaining_secs': remaining_secs}))
+        return is_exceeded, message_count, remaining_secs, member
 
-    async def create_session(self):
-        from .models import ChatSession
-
-        message_count, user_ip, remaining_secs = await self.get_message_limit()
+    @database_sync_to_async
+    def save_session(self):
+        # The session store has no async API, so everything creating a chat session needs is done in one hop
+        from .models import ChatSession, UserIP
+        user_ip = UserIP.objects.get_or_create(ip_address=self.scope['client_ip'])[0]
+        if not self.scope['session'].session_key:
+            self.scope['session'].save()
+        return ChatSession.objects.create(sid=self.scope['session'].session_key, user_ip=user_ip)
 
+    async def create_session(self):
         if self.session is None:
-            if not self.scope['session'].session_key:
-                await database_sync_to_async(self.scope['session'].save)()
-            self.session = await database_sync_to_async(ChatSession.objects.create)(sid=self.scope['session'].session_key, user_ip=user_ip)
+            self.session = await self.save_session()
 
             self.group_name = self.scope['session'].session_key
             await self.channel_layer.group_add(self.group_name, self.channel_name)
 
-        return message_count, user_ip, remaining_secs
-
     async def receive(self, text_data=None, bytes_data=None):
-        text_data_json = json.loads(text_data)
+        text_data_json = loads(text_data)
         command = text_data_json['command']
 
         if command == 'send_message':
-            message_count, user_ip, remaining_secs = await self.create_session()
+            await self.create_session()
 
             message = text_data_json['message'][:100]
             if not self.session.is_human_intercepted and not self.session.agent_requested:
-                if calculate_trigram_similarity(message, contact_keywords) > 0.05 and\
-                   calculate_trigram_similarity(message, agent_keywords) > 0.05:
+                if {'contact', 'agent'} <= intent_matcher.detect(message):
                     # If the user has requested to contact an agent, set agent_requested to True
                     await self.set_agent_requested()
-                    await self.send(text_data=json.dumps({'agent_requested': True}))
+                    await self.send(text_data=dumps({'agent_requested': True}))
                 else:
-                    is_exceeded_msg_limit = (await self.handle_exceeded_msg_limit(message_count, user_ip, remaining_secs, True))[0]
+                    is_exceeded_msg_limit, message_count, remaining_secs, member = await self.handle_exceeded_msg_limit(record=True)
                     if not is_exceeded_msg_limit:
-                        response, total_tokens = await self.genie.ask(message)
-                        await self.get_global_token_limit(total_tokens, True)
-                        imgs = await self.genie.find_imgs(response.residencies)
-                        await self.store_message(self.session, message, response.answer)
-                        await self.send(text_data=json.dumps({
-                            'message': response.answer,
-                            'exceeded_limit': message_count + 1 == MESSAGE_LIMIT_PER_IP,
-                            'remaining_secs': remaining_secs,
-                            'imgs': imgs
-                        }))
+                        # Answer in the background so this socket keeps handling events (and can be
+                        # cancelled on disconnect) while the question is with OpenAI
+                        self.run_in_background(self.answer(
+                            message, member, message_count, remaining_secs, text_data_json.get('stream', False)
+                        ))
             if self.session.is_human_intercepted or self.session.agent_requested:
-                await self.store_message(self.session, message, None)
+                await self.store_message(message, None)
 
         elif command == 'submit_info':
             await self.create_session()
             await self.save_visitor_info(text_data_json['data'])
 
-    @database_sync_to_async
-    def set_agent_requested(self):
-        self.session.refresh_from_db()
+    async def answer(self, message, member, message_count, remaining_secs, stream=False):
+        answered = False
+        try:
+            answered = await self.answer_message(message, message_count, remaining_secs, stream)
+        finally:
+            if not answered:
+                await self.forget_message(member)
+
+    async def answer_message(self, message, message_count, remaining_secs, stream=False):
+        """Answers the message, unless it has to be refused. Returns whether it was answered."""
+        genie = await Genie.get(settings.GENIE_TIMEOUT)
+        if genie is None:
+            await self.send(text_data=dumps({'message': WARMING_ANSWER}))
+            return False
+        names = genie.residency_names(message)
+        response, embedding = await answer_cache.get(genie.index_version, message, names)
+        prompt_tokens = completion_tokens = 0
+        if response is None:
+            # Reserve what the question may cost up front, so concurrent questions can't overshoot the limit
+            estimate = genie.estimate_tokens(message)
+            status, reservation = await self.wait_for_admission(sum(estimate), cost_micros(MODEL_NAME, *estimate))
+            if status == RATE_LIMITED:
+                await self.send(text_data=dumps({'exceeded_limit': True, 'remaining_secs': 60, 'global_limit': True}))
+                return False
+            if status == OVER_BUDGET:
+                await self.send(text_data=dumps({'message': BUDGET_ANSWER}))
+                return False
+            response, prompt_tokens, completion_tokens = await genie.ask(
+                message, self.send_partial if stream else None, spend_mode(reservation['spent']) == ECONOMY
+            )
+            await reconcile(reservation, MODEL_NAME, prompt_tokens, completion_tokens)
+            if response.answer != ERROR_ANSWER:
+                await answer_cache.set(
+                    genie.index_version, message, response, prompt_tokens + completion_tokens, embedding, names
+                )
+        imgs = await genie.find_imgs(response.residencies)
+        await self.store_message(message, response.answer, prompt_tokens, completion_tokens)
+        await self.send(text_data=dumps({
+            'message': response.answer,
+            'residencies': response.residencies,
+            'exceeded_limit': message_count + 1 == MESSAGE_LIMIT_PER_IP,
+            'remaining_secs': remaining_secs,
+            'imgs': imgs
+        }))
+        return True
+
+    async def wait_for_admission(self, tokens, cost):
+        """Returns the admission status and the reservation, once the question is let through to OpenAI."""
+        status, reservation, ticket, position = await admission_queue.admit(self.scope['client_ip'], self.channel_name, tokens, cost)
+        if ticket is None:
+            return status, reservation
+        self.admission = (ticket, asyncio.get_running_loop().create_future())
+        await self.send(text_data=dumps({'queue_position': position}))
+        try:
+            event = await asyncio.wait_for(self.admission[1], settings.ADMISSION_TIMEOUT)
+        except asyncio.TimeoutError:
+            await admission_queue.cancel(self.scope['client_ip'], ticket)
+            return RATE_LIMITED, None
+        except asyncio.CancelledError:
+            await admission_queue.cancel(self.scope['client_ip'], ticket)
+            raise
+        finally:
+            self.admission = None
+        return event['status'], event['reservation']
+
+    async def admission_admitted(self, event):
+        if self.admission and self.admission[0] == event['ticket'] and not self.admission[1].done():
+            self.admission[1].set_result(event)
+        elif event['reservation']:
+            # Nobody is waiting for it anymore
+            await release(event['reservation'])
+
+    async def admission_position(self, event):
+        if self.admission and self.admission[0] == event['ticket']:
+            await self.send(text_data=dumps({'queue_position': event['position']}))
+
+    async def send_partial(self, text):
+        await self.send(text_data=dumps({'partial': text}))
+
+    async def set_agent_requested(self):
+        from .models import ChatSession
+        await ChatSession.objects.filter(pk=self.session.pk).aupdate(agent_requested=True)
         self.session.agent_requested = True
-        self.session.save()
 
-    @database_sync_to_async
-    def save_visitor_info(self, data):
-        from .models import VisitorInfo
-        self.session.refresh_from_db()
+    async def save_visitor_info(self, data):
+        from .models import ChatSession, VisitorInfo
+        await ChatSession.objects.filter(pk=self.session.pk).aupdate(info_provided=True)
         self.session.info_provided = True
-        self.session.save()
 
         # Convert date strings to datetime.date objects
         if 'date_from' in data and isinstance(data['date_from'], str):
@@ -188,93 +230,128 @@ class ChatConsumer(AsyncWebsocketConsumer):
             data['date_until'] = datetime.strptime(data['date_until'], '%Y-%m-%d').date()
 
         # Create or update VisitorInfo
-        visitor_info, created = VisitorInfo.objects.update_or_create(
+        visitor_info, created = await VisitorInfo.objects.aupdate_or_create(
             session=self.session,
             defaults=data
         )
 
-        # After storing the visitor info, broadcast it to the 'panel' group
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            'panel',
-            {
-                'type': 'update_visitor_info',
-                'command': 'visitor_info',
+        # After storing the visitor info, send it to the agents looking at the session
+        panel_event_bus.publish({
+            'command': 'visitor_info',
+            'session_id': self.session.pk,
+            'info': visitor_info.to_dict(),
+        }, self.session.pk)
+
+    async def store_message(self, message, response, prompt_tokens=0, completion_tokens=0):
+        chat_message = await database_sync_to_async(self.session.add_message)(
+            message, response, model=MODEL_NAME if prompt_tokens else '',
+            prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+        )
+        # Committed by now, and everything the panel needs is at hand
+        panel_event_bus.publish({
+            'command': 'new_message',
+            'message': {
+                'id': chat_message.id,
+                'message': chat_message.message,
+                'response': chat_message.response,
+                'file': chat_message.file.name,
                 'session_id': self.session.pk,
-                'info': visitor_info.to_dict(),
             },
-        )
-
-    @staticmethod
-    @database_sync_to_async
-    def store_message(session, message, response):
-        from .models import ChatMessage
-        chat_message = ChatMessage(session=session, message=message, response=response)
-        chat_message.save()
-
-        # Update the session's last_message field
-        session.refresh_from_db()
-        session.last_message = chat_message
-        session.save()
+        }, self.session.pk)
+        panel_event_bus.publish({
+            'command': 'session_activity',
+            'session_id': self.session.pk,
+            'session_name': self.session.name,
+            'message_id': chat_message.id,
+            'last_message_text': chat_message.message,
+        })
 
     async def intercepted_message(self, event):
         # Send message to WebSocket
         self.session.is_human_intercepted = True
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=dumps({
             'message': event['message'],
             'human_intercepted': True
         }))
 
     async def file_uploaded(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.send(text_data=dumps(event))
 
 
 class PanelConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.group_name = 'panel'
-        await self.channel_layer.group_add(self.group_name, self.channel_name)
-        await self.accept()
+        self.session_ids = set()
+        # Agents that can decode it get msgpack frames, which are smaller for long message lists
+        self.codec = negotiate(self.scope.get('subprotocols', []))
+        await self.channel_layer.group_add(SUMMARY_GROUP, self.channel_name)
+        await self.accept(self.codec.subprotocol)
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        await self.subscribe([])
+        await self.channel_layer.group_discard(SUMMARY_GROUP, self.channel_name)
+
+    async def subscribe(self, session_ids):
+        """Replaces the sessions whose events the agent gets in full."""
+        session_ids = set(session_ids)
+        for session_id in self.session_ids - session_ids:
+            await self.channel_layer.group_discard(group_for(session_id), self.channel_name)
+        for session_id in session_ids - self.session_ids:
+            await self.channel_layer.group_add(group_for(session_id), self.channel_name)
+        self.session_ids = session_ids
+
+    async def send_data(self, data, encoded=None):
+        """Sends data in the agent's format, or its already encoded form if encoded has it."""
+        frame = encoded[self.codec.name] if encoded else self.codec.encode(data)
+        if self.codec.binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
 
     async def receive(self, text_data=None, bytes_data=None):
-        text_data_json = json.loads(text_data)
+        text_data_json = self.codec.decode(bytes_data) if bytes_data is not None else loads(text_data)
         command = text_data_json['command']
 
         if command == 'fetch_sessions':
-            sessions = await self.get_sessions()
-            await self.send(text_data=json.dumps({
+            sessions, has_more = await self.get_sessions(text_data_json.get('before'), text_data_json.get('since'))
+            await self.send_data({
                 'command': 'fetch_sessions',
-                'sessions': sessions
-            }))
+                'sessions': sessions,
+                'has_more': has_more,
+                'since': text_data_json.get('since'),
+            })
         elif command == 'fetch_messages':
             session_id = text_data_json['session_id']
-            messages, can_intercept = await self.get_messages(session_id)
-            await self.send(text_data=json.dumps({
+            messages, has_more, can_intercept = await self.get_messages(
+                session_id, text_data_json.get('before'), text_data_json.get('since')
+            )
+            await self.send_data({
                 'command': 'fetch_messages',
+                'session_id': session_id,
                 'messages': messages,
+                'has_more': has_more,
+                'before': text_data_json.get('before'),
+                'since': text_data_json.get('since'),
                 'can_intercept': can_intercept
-            }, cls=DateTimeEncoder))
+            })
 
         elif command == 'delete_session':
             session_id = text_data_json['session_id']
             await self.delete_session(session_id)
-            await self.send(text_data=json.dumps({
+            await self.send_data({
                 'command': 'deleted_session',
                 'session_id': session_id
-            }))
+            })
 
         elif command == 'rename_session':
             session_id = text_data_json['session_id']
             new_name = text_data_json['new_name']
-            session = await self.rename_session(session_id, new_name)
-            await self.send(text_data=json.dumps({
+            await self.rename_session(session_id, new_name)
+            await self.send_data({
                 'command': 'renamed_session',
                 'session_id': session_id,
-                'last_message_text': await self.get_last_message(session),
+                'last_message_text': await self.get_last_message(session_id),
                 'new_name': new_name
-            }))
+            })
 
         elif command == 'intercept_session':
             session_id = text_data_json['session_id']
@@ -282,105 +359,101 @@ class PanelConsumer(AsyncWebsocketConsumer):
             if interception_successful:
                 chat_message = await self.send_message(session_id, text_data_json['message'])
                 is_interceptor = await self.check_is_interceptor(session_id)
-                await self.send(text_data=json.dumps({
+                await self.send_data({
                     'command': 'intercepted_session',
                     'session_id': session_id,
                     'is_interceptor': is_interceptor,
                     'message': chat_message.to_dict()
-                }, cls=DateTimeEncoder))
+                })
                 await self.channel_layer.group_send(await self.get_session_sid_by_id(session_id), {
                     'type': 'intercepted_message',
                     'message': chat_message.response
                 })
             else:
-                await self.send(text_data=json.dumps({
+                await self.send_data({
                     'command': 'interception_failed',
                     'session_id': session_id,
                     'reason': 'Session has already been intercepted'
-                }))
+                })
+
+        elif command == 'subscribe':
+            await self.subscribe(int(session_id) for session_id in text_data_json['session_ids'])
 
         elif command == 'fetch_visitor_info':
             session_id = text_data_json['session_id']
             visitor_info = await self.fetch_visitor_info(session_id)
             if visitor_info:
-                await self.send(text_data=json.dumps({
+                await self.send_data({
                     'command': 'visitor_info',
                     'session_id': session_id,
                     'info': visitor_info.to_dict()
-                }))
+                })
 
-    @database_sync_to_async
-    def fetch_visitor_info(self, session_id):
+    async def fetch_visitor_info(self, session_id):
         from .models import VisitorInfo
-        return VisitorInfo.objects.filter(session_id=session_id).first()
+        return await VisitorInfo.objects.filter(session_id=session_id).afirst()
 
-    @database_sync_to_async
-    def check_is_interceptor(self, session_id):
+    async def check_is_interceptor(self, session_id):
         from .models import ChatSession
-        return ChatSession.objects.filter(pk=session_id, human_agent=self.scope['user']).exists()
+        return await ChatSession.objects.filter(pk=session_id, human_agent=self.scope['user']).aexists()
 
-    @database_sync_to_async
-    def get_session_sid_by_id(self, session_id):
+    async def get_session_sid_by_id(self, session_id):
         from .models import ChatSession
-        return ChatSession.objects.get(pk=session_id).sid
+        return await ChatSession.objects.values_list('sid', flat=True).aget(pk=session_id)
 
-    @database_sync_to_async
-    def intercept_session(self, session_id):
+    async def intercept_session(self, session_id):
         from .models import ChatSession
-        session = ChatSession.objects.get(id=session_id)
-        # Only allow interception if the session hasn't been intercepted before
-        if not session.is_human_intercepted:
-            session.is_human_intercepted = True
-            session.human_agent = self.scope['user']
-            session.save()
+        # Only allow interception if the session hasn't been intercepted before, checked and set in one UPDATE
+        if await ChatSession.objects.filter(pk=session_id, is_human_intercepted=False).aupdate(
+            is_human_intercepted=True, human_agent=self.scope['user']
+        ):
             return True
-        elif session.human_agent == self.scope['user']:
-            return True
-        else:
-            return False
+        return await self.check_is_interceptor(session_id)
 
-    @database_sync_to_async
-    def send_message(self, session_id, response):
+    async def send_message(self, session_id, response):
         from .models import ChatMessage
-        return ChatMessage.objects.create(session_id=session_id, message=None, response=response)
-
-    @database_sync_to_async
-    def get_last_message(self, session):
-        return session.last_message.message
+        return await ChatMessage.objects.acreate(session_id=session_id, message=None, response=response)
 
-    @database_sync_to_async
-    def delete_session(self, session_id):
+    async def get_last_message(self, session_id):
         from .models import ChatSession
-        ChatSession.objects.get(id=session_id).delete()
+        return await ChatSession.objects.filter(pk=session_id).values_list('last_message__message', flat=True).afirst()
 
-    @database_sync_to_async
-    def rename_session(self, session_id, new_name):
+    async def delete_session(self, session_id):
         from .models import ChatSession
-        session = ChatSession.objects.get(id=session_id)
-        session.name = new_name
-        session.save()
-        return session
+        await (await ChatSession.objects.aget(id=session_id)).adelete()
 
-    @database_sync_to_async
-    def get_sessions(self):
+    async def rename_session(self, session_id, new_name):
         from .models import ChatSession
-        return list(ChatSession.objects.all().annotate(last_message_text=F('last_message__message')).order_by('pk').values())
+        await ChatSession.objects.filter(id=session_id).aupdate(name=new_name)
 
-    @database_sync_to_async
-    def get_messages(self, session_id):
+    async def get_sessions(self, before=None, since=None):
+        """
+        Returns a page of sessions, newest first and older than the before id if given, and whether there are
+        more. With a since cursor ({'session': id, 'message': id}) returns all sessions created or written to after it.
+        """
+        from .models import ChatSession
+        queryset = ChatSession.objects.annotate(last_message_text=F('last_message__message'))
+        if since:
+            queryset = queryset.filter(Q(pk__gt=since['session']) | Q(last_message_id__gt=since['message']))
+            return [session async for session in queryset.order_by('pk').values()], False
+        if before:
+            queryset = queryset.filter(pk__lt=before)
+        sessions = [session async for session in queryset.order_by('-pk').values()[:PANEL_PAGE_SIZE + 1]]
+        return sessions[:PANEL_PAGE_SIZE], len(sessions) > PANEL_PAGE_SIZE
+
+    async def get_messages(self, session_id, before=None, since=None):
+        """Like get_sessions, but the page is in chronological order and since is a message id."""
         from .models import ChatSession, ChatMessage
-        session = ChatSession.objects.get(pk=session_id)
-        return list(ChatMessage.objects.filter(session_id=session_id).order_by('pk').values()), \
-            not session.is_terminated and (not session.is_human_intercepted or self.scope['user'] == session.human_agent)
-
-    async def chat_message(self, event):
-        await self.send(text_data=json.dumps(event, cls=DateTimeEncoder))
-
-    async def chat_session(self, event):
-        await self.send(text_data=json.dumps(event, cls=DateTimeEncoder))
-
-    async def update_visitor_info(self, event):
-        await self.send(text_data=json.dumps(event))
-
-    async def file_uploaded(self, event):
-        await self.send(text_data=json.dumps(event))
+        session = await ChatSession.objects.aget(pk=session_id)
+        can_intercept = not session.is_terminated and (not session.is_human_intercepted or self.scope['user'].pk == session.human_agent_id)
+        queryset = ChatMessage.objects.filter(session_id=session_id)
+        if since:
+            return [message async for message in queryset.filter(pk__gt=since).order_by('pk').values()], False, can_intercept
+        if before:
+            queryset = queryset.filter(pk__lt=before)
+        messages = [message async for message in queryset.order_by('-pk').values()[:PANEL_PAGE_SIZE + 1]]
+        return messages[:PANEL_PAGE_SIZE][::-1], len(messages) > PANEL_PAGE_SIZE, can_intercept
+
+    async def panel_batch(self, event):
+        # Encoded once by the bus, for every agent in the group
+        await self.send_data(None, event['encoded'])
@@ -0,0 +1,76 @@
+from langchain.docstore.document import Document as LCDocument
+
+from chatbot.utils import normalize_question
+
+# Shortest text two chunks have to share to count as overlapping, so a common phrase doesn't join unrelated ones
+MIN_OVERLAP = 50
+# Shorter lines (headings, "Cena:" and the like) are kept even if repeated, as they mean something only in place
+MIN_DEDUPE_LENGTH = 20
+
+
+def overlap(first, second):
+    """Length of the longest end of first that second starts with, or 0 if it's shorter than MIN_OVERLAP."""
+    if len(second) < MIN_OVERLAP:
+        return 0
+    head = second[:MIN_OVERLAP]
+    start = first.find(head)
+    while start != -1:
+        if second.startswith(first[start:]):
+            return len(first) - start
+        start = first.find(head, start + 1)
+    return 0
+
+
+def merge_overlapping(docs):
+    """
+    Joins chunks of the same document that the splitter cut with an overlap into one passage, in the place of
+    the more relevant of them, so the overlap is in the prompt only once.
+    """
+    docs = list(docs)
+    merged = True
+    while merged:
+        merged = False
+        for i, first in enumerate(docs):
+            for j, second in enumerate(docs):
+                if i == j or first.metadata.get('document_id') != second.metadata.get('document_id'):
+                    continue
+                length = overlap(first.page_content, second.page_content)
+                if length:
+                    docs[min(i, j)] = LCDocument(
+                        page_content=first.page_content + second.page_content[length:], metadata=first.metadata
+                    )
+                    del docs[max(i, j)]
+                    merged = True
+                    break
+            if merged:
+                break
+    return docs
+
+
+def build_context(docs, max_tokens, encoding):
+    """
+    Turns the retrieved chunks (most relevant first) into the ones to put in the prompt: overlapping chunks
+    merged, lines already given dropped, and filled up to max_tokens in that order. A chunk is cut at the first
+    line that doesn't fit, as leaving out lines in between could put a fact under the wrong heading, but less
+    relevant chunks can still fill the rest.
+    """
+    seen = set()
+    remaining = max_tokens
+    context = []
+    for doc in merge_overlapping(docs):
+        lines = []
+        for line in doc.page_content.split('\n'):
+            key = normalize_question(line)
+            dedupe = len(key) >= MIN_DEDUPE_LENGTH
+            if dedupe and key in seen:
+                continue
+            tokens = len(encoding.encode(line)) + 1
+            if tokens > remaining:
+                break
+            remaining -= tokens
+            lines.append(line)
+            if dedupe:
+                seen.add(key)
+        if any(line.strip() for line in lines):
+            context.append(LCDocument(page_content='\n'.join(lines).strip(), metadata=doc.metadata))
+    return context
@@ -0,0 +1,44 @@
+import math
+
+from django.conf import settings
+from django.utils import timezone
+
+# USD per 1K prompt and completion tokens
+PRICES = {
+    'gpt-3.5-turbo-0613': (0.0015, 0.002),
+    'gpt-3.5-turbo-16k-0613': (0.003, 0.004),
+    'gpt-4-0613': (0.03, 0.06),
+}
+# Spend is counted in millionths of a dollar, so the Redis counters stay integers
+MICROS = 1000000
+MONTH_KEY = 'spend:month:%s'
+DAY_KEY = 'spend:day:%s'
+
+NORMAL, ECONOMY, CACHE_ONLY = 'normal', 'economy', 'cache_only'
+
+
+def cost_micros(model, prompt_tokens, completion_tokens):
+    prompt_price, completion_price = PRICES[model]
+    return math.ceil((prompt_tokens * prompt_price + completion_tokens * completion_price) * MICROS / 1000)
+
+
+def spend_keys(when=None):
+    when = timezone.localtime(when)
+    return [MONTH_KEY % when.strftime('%Y-%m'), DAY_KEY % when.strftime('%Y-%m-%d')]
+
+
+def budget_limit_micros():
+    """What may be spent on new answers this month, or 0 if there's no budget. The rest is left for cached ones."""
+    return int(settings.MONTHLY_BUDGET_USD * settings.BUDGET_CACHE_ONLY_RATIO * MICROS)
+
+
+def spend_mode(spent):
+    """How questions are answered after spending this much (in micros) this month."""
+    if not settings.MONTHLY_BUDGET_USD:
+        return NORMAL
+    budget = settings.MONTHLY_BUDGET_USD * MICROS
+    if spent >= budget * settings.BUDGET_CACHE_ONLY_RATIO:
+        return CACHE_ONLY
+    if spent >= budget * settings.BUDGET_ECONOMY_RATIO:
+        return ECONOMY
+    return NORMAL
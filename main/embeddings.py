@@ -0,0 +1,70 @@
+import hashlib
+import traceback
+
+import numpy as np
+from django.conf import settings
+from langchain.embeddings import OpenAIEmbeddings
+from langchain.embeddings.base import Embeddings
+
+from chatbot.utils import normalize_question
+from .redis_init import async_redis_conn, redis_conn
+
+KEY = 'embedding:%s:%s'
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Query embeddings shared by all workers through Redis, as float32 bytes under the model and the normalised
+    query, so a question asked before (or the same one asked again by the answer cache and the retriever)
+    skips the round-trip to OpenAI. Documents are embedded once per index build, so they go straight through.
+    """
+
+    def __init__(self, embeddings=None):
+        self.embeddings = embeddings or OpenAIEmbeddings()
+
+    def key(self, text):
+        return KEY % (self.embeddings.model, hashlib.sha1(normalize_question(text).encode('utf-8')).hexdigest())
+
+    @staticmethod
+    def encode(embedding):
+        return np.asarray(embedding, dtype=np.float32).tobytes()
+
+    @staticmethod
+    def decode(data):
+        return np.frombuffer(data, dtype=np.float32).tolist()
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts):
+        return await self.embeddings.aembed_documents(texts)
+
+    def embed_query(self, text):
+        key = self.key(text)
+        try:
+            data = redis_conn.get(key)
+            if data is not None:
+                return self.decode(data)
+        except Exception:
+            traceback.print_exc()
+        embedding = self.embeddings.embed_query(text)
+        try:
+            redis_conn.set(key, self.encode(embedding), ex=settings.EMBEDDING_CACHE_TTL)
+        except Exception:
+            traceback.print_exc()
+        return embedding
+
+    async def aembed_query(self, text):
+        key = self.key(text)
+        try:
+            data = await async_redis_conn.get(key)
+            if data is not None:
+                return self.decode(data)
+        except Exception:
+            traceback.print_exc()
+        embedding = await self.embeddings.aembed_query(text)
+        try:
+            await async_redis_conn.set(key, self.encode(embedding), ex=settings.EMBEDDING_CACHE_TTL)
+        except Exception:
+            traceback.print_exc()
+        return embedding
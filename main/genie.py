@@ -1,100 +1,187 @@
-import os
+import asyncio
+import json
 import pickle
-import re
 import traceback
+from functools import lru_cache
 
-import requests
-from bs4 import BeautifulSoup
-from channels.db import database_sync_to_async
+import openai
+import tiktoken
+from asgiref.sync import sync_to_async
 from langchain.callbacks import get_openai_callback
 from langchain.prompts import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
 # from langchain.retrievers import SVMRetriever
 from langchain.schema import HumanMessage
-from langchain.vectorstores import Chroma
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter # , SpacyTextSplitter
 from langchain.chat_models import ChatOpenAI
+from langchain.chat_models.openai import _convert_message_to_dict
 from langchain.chains import RetrievalQA, create_qa_with_structure_chain, StuffDocumentsChain
 from langchain import PromptTemplate
 
 from django.conf import settings
+from django.db import connections
 
+from main.index import index_path, open_index
+from main.ingestion import STATS_NAME
+from main.links import link_cache
+from main.reload import ensure_version
+from main.residencies import ResidencyIndex
+from main.retrieval import HybridRetriever, LexicalIndex
 from main.schema import CustomResponseSchema
+from main.scraper import gallery_scraper
+from main.streaming import LinkStream, PartialAnswerParser
 
-PRE_SPLITTED_TEXTS_PATH = settings.MEDIA_ROOT / 'documents/texts.pkl'
-TEXTS_PATH = settings.MEDIA_ROOT / 'documents/texts_splitted.pkl'
+ERROR_ANSWER = "Dogodila se greška. Molimo pokušajte ponovo."
+BUDGET_ANSWER = "Chatbot trenutno ne može da odgovori na nova pitanja. Molimo pokušajte ponovo kasnije."
+WARMING_ANSWER = "Chatbot se upravo pokreće. Molimo pokušajte ponovo za minut."
+MODEL_NAME = 'gpt-3.5-turbo-0613'
+# Allowance for the answer when estimating what a question will cost
+COMPLETION_TOKENS_ESTIMATE = 500
+
+# The same function definition create_qa_with_structure_chain gives to the model
+RESPONSE_SCHEMA = CustomResponseSchema.schema()
+RESPONSE_FUNCTION = {
+    'name': RESPONSE_SCHEMA['title'],
+    'description': RESPONSE_SCHEMA['description'],
+    'parameters': RESPONSE_SCHEMA,
+}
+
+
+@lru_cache(maxsize=None)
+def get_encoding():
+    return tiktoken.encoding_for_model(MODEL_NAME)
+
+
+def count_tokens(message_dicts, completion):
+    # Roughly how OpenAI bills a chat completion: message contents plus a few tokens of framing each
+    encoding = get_encoding()
+    prompt_tokens = sum(len(encoding.encode(message['content'])) + 4 for message in message_dicts)
+    prompt_tokens += len(encoding.encode(json.dumps(RESPONSE_FUNCTION)))
+    return prompt_tokens, len(encoding.encode(completion))
 
 
 class Genie:
-    genie = None
-
-    def __init__(self, documents):
-        if Genie.genie is None:
-            self.documents = documents
-            self.texts = self.load_texts()
-            vectordb = self.embeddings(self.texts)
-            prompt_messages = [
-                SystemMessagePromptTemplate.from_template_file(settings.MEDIA_ROOT / 'prompt.txt', []),
-                HumanMessage(content="Answer question using the following context"),
-                HumanMessagePromptTemplate.from_template("{context}"),
-                HumanMessagePromptTemplate.from_template("Question: {question}"),
-            ]
-            chain_prompt = ChatPromptTemplate(messages=prompt_messages)
-            llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo-0613")
-            qa_chain = create_qa_with_structure_chain(llm, CustomResponseSchema, output_parser="pydantic", prompt=chain_prompt)
-            document_prompt = PromptTemplate(
-                input_variables=["page_content"],
-                template="{page_content}"
-            )
-            final_qa_chain = StuffDocumentsChain(
-                llm_chain=qa_chain,
-                document_variable_name="context",
-                document_prompt=document_prompt,
-            )
-            Genie.genie = RetrievalQA(
-                retriever=vectordb.as_retriever(), combine_documents_chain=final_qa_chain
-            )
-
-    def load_texts(self):
-        if os.path.exists(TEXTS_PATH):
-            with open(TEXTS_PATH, 'rb') as f:
-                return pickle.load(f)
-        else:
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1600, chunk_overlap=350, separators=['\n', '\.'])
-            pre_splitted_texts = []
-            texts = []
-            for document in self.documents:
-                processed_txt = document.preprocess_text()
-                pre_splitted_texts.extend(processed_txt)
-                texts.extend(text_splitter.split_documents(processed_txt))
-            with open(PRE_SPLITTED_TEXTS_PATH, 'wb') as f:
-                pickle.dump(pre_splitted_texts, f)
-            with open(TEXTS_PATH, 'wb') as f:
-                pickle.dump(texts, f)
-            return texts
+    """
+    One built knowledge base and chain. Each process serves questions from Genie.current, which is built
+    at startup and replaced as a whole, so questions already in flight finish on the instance they started with.
+    """
+    COLD, WARMING, READY, FAILED = 'cold', 'warming', 'ready', 'failed'
+
+    current = None
+    state = COLD
+    warm_up_task = None
+    ready_event = None
+    semaphore = None
+
+    def __init__(self, version):
+        self.index_version = version
+        self.residency_index = None
+        stats = self.load_version_files()
+        # Put to use once this instance is swapped in, the current one answers with the links it was built with
+        self.link_urls = link_cache.fetch()
+        vectordb = open_index(version)
+        prompt_messages = [
+            SystemMessagePromptTemplate.from_template_file(settings.MEDIA_ROOT / 'prompt.txt', []),
+            HumanMessage(content="Answer question using the following context"),
+            HumanMessagePromptTemplate.from_template("{context}"),
+            HumanMessagePromptTemplate.from_template("Question: {question}"),
+        ]
+        self.chain_prompt = ChatPromptTemplate(messages=prompt_messages)
+        encoding = get_encoding()
+        self.max_chunk_tokens = stats['max_chunk_tokens']
+        llm = ChatOpenAI(temperature=0, model=MODEL_NAME, request_timeout=settings.GENIE_TIMEOUT)
+        qa_chain = create_qa_with_structure_chain(llm, CustomResponseSchema, output_parser="pydantic", prompt=self.chain_prompt)
+        document_prompt = PromptTemplate(
+            input_variables=["page_content"],
+            template="{page_content}"
+        )
+        final_qa_chain = StuffDocumentsChain(
+            llm_chain=qa_chain,
+            document_variable_name="context",
+            document_prompt=document_prompt,
+        )
+        lexical = self.lexical = LexicalIndex.build(vectordb, self.link_urls)
+        self.genie = RetrievalQA(
+            retriever=HybridRetriever(
+                vectorstore=vectordb, lexical=lexical, search_kwargs={'k': settings.RETRIEVER_K},
+                max_tokens=settings.CONTEXT_MAX_TOKENS, encoding=encoding,
+            ),
+            combine_documents_chain=final_qa_chain,
+        )
+        # Used once most of the monthly budget is spent, as a smaller context makes questions cheaper
+        self.economy_genie = RetrievalQA(
+            retriever=HybridRetriever(
+                vectorstore=vectordb, lexical=lexical, search_kwargs={'k': settings.BUDGET_ECONOMY_CHUNKS},
+                max_tokens=settings.CONTEXT_MAX_TOKENS, encoding=encoding,
+            ),
+            combine_documents_chain=final_qa_chain,
+        )
+
+    @classmethod
+    def build(cls):
+        try:
+            return cls(ensure_version())
+        finally:
+            # Built in a thread of its own, whose connection nothing else would close
+            connections.close_all()
+
+    @classmethod
+    def start_warm_up(cls):
+        """Builds a new instance in the background and swaps it in once ready. Does nothing if a build is running."""
+        if cls.warm_up_task is None or cls.warm_up_task.done():
+            cls.warm_up_task = asyncio.get_running_loop().create_task(cls.warm_up())
+        return cls.warm_up_task
+
+    @classmethod
+    async def warm_up(cls):
+        if cls.current is None:
+            cls.state = cls.WARMING
+        try:
+            # Not on the worker's thread for database calls, as building can take minutes (longer still if another
+            # worker holds the index build lock) and the consumers' queries would wait on it all along
+            genie = await sync_to_async(cls.build, thread_sensitive=False)()
+        except Exception:
+            traceback.print_exc()
+            if cls.current is None:
+                cls.state = cls.FAILED
+            return
+        # A single assignment, so every question sees either the old instance or the new one
+        cls.current = genie
+        link_cache.use(genie.link_urls)
+        cls.state = cls.READY
+        cls.get_ready_event().set()
+
+    @classmethod
+    def get_ready_event(cls):
+        if cls.ready_event is None:
+            cls.ready_event = asyncio.Event()
+        return cls.ready_event
+
+    @classmethod
+    async def get(cls, timeout=None):
+        """Returns the current instance, waiting up to timeout seconds for the first one to be built."""
+        if cls.current is None:
+            if cls.state in (cls.COLD, cls.FAILED):
+                cls.start_warm_up()
+            try:
+                await asyncio.wait_for(cls.get_ready_event().wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return cls.current
+
+    def load_version_files(self):
+        # From the version's directory, so they always match its index. Returns the stats of its chunks
+        path = index_path(self.index_version)
+        self.residency_index = ResidencyIndex.load(path)
+        self.residency_index.load_links()
+        # The texts themselves aren't needed, the index keeps the chunks
+        with open(path / STATS_NAME, 'rb') as f:
+            return pickle.load(f)
 
     @staticmethod
-    def embeddings(texts):
-        embeddings = OpenAIEmbeddings()
-        vectordb = Chroma.from_documents(texts, embeddings, persist_directory=os.path.join(settings.MEDIA_ROOT, 'chroma'))
-        vectordb.persist()
-        return vectordb
-
-    @database_sync_to_async
-    def replace_links(self, resp):
-        from .models import LINK_PLACEHOLDER, LINK_REGEX, Link
-        link_ids = [int(id) for id in re.findall(LINK_REGEX, resp.answer)]
-        links = Link.objects.filter(id__in=link_ids)
-        for link in links:
-            resp.answer = resp.answer.replace(LINK_PLACEHOLDER % link.pk, link.url)
+    def replace_links(resp):
+        resp.answer = link_cache.resolve(resp.answer)
         return resp
 
-    @database_sync_to_async
-    def find_imgs(self, lst):
-        from main.models import LINK_REGEX, Link
-        with open(PRE_SPLITTED_TEXTS_PATH, 'rb') as f:
-            texts = pickle.load(f)
-
+    async def find_imgs(self, lst):
         imgs = []
         link_ids = {}
 
@@ -102,77 +189,98 @@ class Genie:
             item = item.strip()
             if not item:
                 continue
-            match_before = False
-            prev_line = ''
-            for chunk in texts:
-                # Loop through each line in page content
-                for line in chunk.page_content.split('\n'):
-                    # Case insensitive search
-                    if item.lower() in line.lower() or match_before:
-                        # Find link IDs
-                        link_id = re.search(LINK_REGEX, line)
-                        if not link_id:
-                            link_id = re.search(LINK_REGEX, prev_line)
-                        if not link_id:
-                            if not match_before:
-                                match_before = True
-                            else:
-                                match_before = False
-                            prev_line = line
-                            continue
-                        link_id = int(link_id.group(1))
-                        if link_id in link_ids:
-                            for i, img in enumerate(imgs):
-                                if img['name'] == link_ids[link_id]:
-                                    imgs.append({'name': link_ids[link_id] + ', ' + item, 'link': img['link'], 'images': img['images']})
-                                    del imgs[i]
-                                    break
-                            continue
-                        try:
-                            link = Link.objects.get(id=link_id)
-                        except:
-                            continue
-
-                        if not link.img_links:
-                            response = requests.get(link.url)
-                            soup = BeautifulSoup(response.text, 'html.parser')
-
-                            # Look for div elements with "gallery" in class
-                            gallery_elements = soup.find_all(lambda tag: tag.name == 'div' and 'gallery__full-image' in tag.get('class', []))
-
-                            img_links = set()
-                            for element in gallery_elements:
-                                # Look for img tags within those elements and extract the 'src' attribute
-                                for img in element.find_all('img'):
-                                    val = img.get('src') or img.get('data-src')
-                                    if val:
-                                        img_links.add(val)
-
-                            img_links = list(img_links)
-                            # Update the Link model
-                            link.img_links = ','.join(img_links)
-                            link.save()
-                            imgs.append({'name': item, 'link': link.url, 'images': img_links})
-                        else:
-                            imgs.append({'name': item, 'link': link.url, 'images': link.img_links.split(',')})
-                        link_ids[link.pk] = item
+            link_id = self.residency_index.find(item)
+            link = self.residency_index.links.get(link_id)
+            if not link:
+                continue
+            if link_id in link_ids:
+                for i, img in enumerate(imgs):
+                    if img['name'] == link_ids[link_id]:
+                        link_ids[link_id] += ', ' + item
+                        imgs.append({'name': link_ids[link_id], 'link': img['link'], 'images': img['images']})
+                        del imgs[i]
                         break
-                    prev_line = line
-                else:
-                    continue
-                break
+                continue
+            if link['images'] is None:
+                # Don't keep the visitor waiting on it, the next answer will have the gallery
+                await gallery_scraper.enqueue(link_id)
+            imgs.append({'name': item, 'link': link['url'], 'images': link['images'] or []})
+            link_ids[link_id] = item
         return imgs
 
-    async def ask(self, query: str):
+    @classmethod
+    def get_semaphore(cls):
+        # Created lazily so it binds to the event loop of the worker that uses it
+        if cls.semaphore is None:
+            cls.semaphore = asyncio.Semaphore(settings.GENIE_MAX_CONCURRENCY)
+        return cls.semaphore
+
+    def residency_names(self, query):
+        return self.lexical.names(query)
+
+    def estimate_tokens(self, query):
+        """
+        An upper estimate of the prompt and completion tokens answering the query takes, assuming the
+        largest chunks are retrieved (or as many as the context budget allows).
+        """
+        messages = self.chain_prompt.format_messages(context='', question=query)
+        prompt_tokens = count_tokens([_convert_message_to_dict(message) for message in messages], '')[0]
+        context_tokens = min(self.genie.retriever.search_kwargs.get('k', 4) * self.max_chunk_tokens, settings.CONTEXT_MAX_TOKENS)
+        return prompt_tokens + context_tokens, COMPLETION_TOKENS_ESTIMATE
+
+    async def stream(self, query: str, on_partial, genie):
+        """
+        Runs the same retrieval and prompt as the chain, but streams the function call so on_partial gets
+        each new piece of the answer (with links already resolved) while the rest is still being generated.
+        """
+        docs = await genie.retriever.aget_relevant_documents(query)
+        messages = self.chain_prompt.format_messages(context='\n\n'.join(doc.page_content for doc in docs), question=query)
+        message_dicts = [_convert_message_to_dict(message) for message in messages]
+        parser = PartialAnswerParser()
+        links = LinkStream(link_cache.resolve)
+        response = await openai.ChatCompletion.acreate(
+            model=MODEL_NAME,
+            messages=message_dicts,
+            functions=[RESPONSE_FUNCTION],
+            function_call={'name': RESPONSE_FUNCTION['name']},
+            temperature=0,
+            stream=True,
+            request_timeout=settings.GENIE_TIMEOUT,
+        )
+        async for chunk in response:
+            arguments = chunk['choices'][0]['delta'].get('function_call', {}).get('arguments', '')
+            text = links.feed(parser.feed(arguments))
+            if text:
+                await on_partial(text)
+        text = links.flush()
+        if text:
+            await on_partial(text)
+        # Streamed responses carry no usage, so count the tokens ourselves
+        return CustomResponseSchema.parse_raw(parser.arguments), *count_tokens(message_dicts, parser.arguments)
+
+    async def ask(self, query: str, on_partial=None, economy=False):
+        """Returns the response and the prompt and completion tokens it took."""
+        genie = self.economy_genie if economy else self.genie
+        streamed_tokens = (0, 0)
         with get_openai_callback() as cb:
             try:
-                resp = self.genie.run(query)
+                async with self.get_semaphore():
+                    if on_partial:
+                        resp, *streamed_tokens = await asyncio.wait_for(self.stream(query, on_partial, genie), settings.GENIE_TIMEOUT)
+                    else:
+                        resp = await asyncio.wait_for(genie.arun(query), settings.GENIE_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f"Timed out after {settings.GENIE_TIMEOUT}s answering: {query}")
+                resp = CustomResponseSchema(
+                    residencies=[],
+                    answer=ERROR_ANSWER,
+                )
             except Exception as e:
                 print(f"Exception occurred: {e}")
                 traceback.print_exc()  # This prints the stack trace
                 resp = CustomResponseSchema(
                     residencies=[],
-                    answer="Dogodila se greška. Molimo pokušajte ponovo.",
+                    answer=ERROR_ANSWER,
                 )
             print(cb)
-            return await self.replace_links(resp), cb.total_tokens
+            return self.replace_links(resp), cb.prompt_tokens + streamed_tokens[0], cb.completion_tokens + streamed_tokens[1]
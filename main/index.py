@@ -0,0 +1,215 @@
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import shutil
+
+import numpy as np
+from django.conf import settings
+from langchain.docstore.document import Document as LCDocument
+from langchain.embeddings import OpenAIEmbeddings
+from langchain.vectorstores import Chroma
+from langchain.vectorstores.base import VectorStore
+
+from .embeddings import CachedEmbeddings
+from .redis_init import redis_conn
+
+CHROMA_PATH = settings.MEDIA_ROOT / 'chroma'
+MANIFEST_PATH = CHROMA_PATH / 'manifest.json'
+INDEX_PATH = settings.MEDIA_ROOT / 'index'
+BUILD_LOCK_KEY = 'index:build'
+BUILD_TIMEOUT = 30 * 60
+# Index versions kept on disk, counting the current one
+KEEP_VERSIONS = 2
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def index_version(chunk_ids):
+    return content_hash(''.join(sorted(chunk_ids)))[:16]
+
+
+def sync_index(texts):
+    """
+    Reopens the persisted collection, embeds only chunks it doesn't have yet and drops the ones that are gone.
+    Returns the collection and a version that changes whenever the set of chunks does.
+    """
+    vectordb = Chroma(persist_directory=str(CHROMA_PATH), embedding_function=OpenAIEmbeddings())
+
+    chunks = {}
+    for text in texts:
+        chunks.setdefault(content_hash(text.page_content), text)
+
+    existing_ids = set(vectordb._collection.get(include=[])['ids'])
+    new_ids = [chunk_id for chunk_id in chunks if chunk_id not in existing_ids]
+    orphan_ids = list(existing_ids - chunks.keys())
+
+    if orphan_ids:
+        vectordb._collection.delete(ids=orphan_ids)
+    if new_ids:
+        vectordb.add_texts(
+            [chunks[chunk_id].page_content for chunk_id in new_ids],
+            [chunks[chunk_id].metadata for chunk_id in new_ids],
+            ids=new_ids,
+        )
+    vectordb.persist()
+    version = index_version(chunks)
+    write_manifest(texts, version)
+    print(f"Index synced: {len(new_ids)} embedded, {len(orphan_ids)} removed, {len(chunks) - len(new_ids)} reused")
+    return vectordb, version
+
+
+def write_manifest(texts, version):
+    documents = {}
+    for text in texts:
+        entry = documents.setdefault(str(text.metadata.get('document_id')), {
+            'name': text.metadata.get('document_name'),
+            'file_hash': text.metadata.get('file_hash'),
+            'chunks': [],
+        })
+        chunk_id = content_hash(text.page_content)
+        if chunk_id not in entry['chunks']:
+            entry['chunks'].append(chunk_id)
+    with open(MANIFEST_PATH, 'w') as f:
+        json.dump({'version': version, 'documents': documents}, f, indent=2)
+
+
+
+def export_index(vectordb, path, files=None):
+    """
+    Writes the collection out as a contiguous float32 matrix of normalised vectors, the chunk texts as one blob
+    with an offset table and their metadata, plus the given files ({name: object}) pickled. Written to a temporary
+    directory first, so readers never see half of it.
+    """
+    data = vectordb._collection.get(include=['embeddings', 'documents', 'metadatas'])
+    tmp_path = path.with_name(path.name + '.tmp')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    vectors = np.asarray(data['embeddings'], dtype=np.float32).reshape(len(data['ids']), -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.save(tmp_path / 'vectors.npy', vectors / np.where(norms == 0, 1, norms))
+    blobs = [document.encode('utf-8') for document in data['documents']]
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    np.cumsum([len(blob) for blob in blobs], out=offsets[1:])
+    np.save(tmp_path / 'offsets.npy', offsets)
+    with open(tmp_path / 'chunks.bin', 'wb') as f:
+        f.write(b''.join(blobs))
+    with open(tmp_path / 'metadata.json', 'w') as f:
+        json.dump(data['metadatas'], f)
+    for name, obj in (files or {}).items():
+        with open(tmp_path / name, 'wb') as f:
+            pickle.dump(obj, f)
+    os.rename(tmp_path, path)
+
+
+def build_lock():
+    """The lock everything building the texts or the index (in any worker or command) is done under."""
+    return redis_conn.lock(BUILD_LOCK_KEY, timeout=BUILD_TIMEOUT, blocking_timeout=BUILD_TIMEOUT)
+
+
+def index_path(version):
+    return INDEX_PATH / version
+
+
+def is_built(version, files=()):
+    path = index_path(version)
+    return os.path.exists(path) and all(os.path.exists(path / name) for name in files)
+
+
+def build_index(texts, files=None):
+    """
+    Builds the index version of the texts (embedding only new chunks) with the given files, if it doesn't exist
+    yet. Needs the build lock held. Returns its path and version.
+    """
+    version = index_version({content_hash(text.page_content) for text in texts})
+    path = index_path(version)
+    if not is_built(version, files or ()):
+        # Left by a build that didn't keep the files yet
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(INDEX_PATH, exist_ok=True)
+        vectordb, version = sync_index(texts)
+        export_index(vectordb, path, files)
+    return path, version
+
+
+def open_index(version):
+    """
+    Memory-maps an index version. Every worker maps the same files, so the OS keeps one copy of it in memory
+    however many workers there are.
+    """
+    return MmapVectorStore(index_path(version), CachedEmbeddings())
+
+
+def collect_garbage(version, keep=KEEP_VERSIONS):
+    """
+    Deletes index versions but the given one and the keep - 1 newest others, which workers may still be
+    swapping out. Workers still mapping a deleted version keep reading it until they let go of it.
+    """
+    versions = [entry for entry in os.scandir(INDEX_PATH) if entry.is_dir() and '.' not in entry.name and entry.name != version]
+    versions.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in versions[keep - 1:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+        print(f"Removed index version {entry.name}")
+
+
+class MmapVectorStore(VectorStore):
+    """A read-only vector store over an index written by export_index, searched by brute-force cosine similarity."""
+
+    def __init__(self, path, embedding):
+        self.embedding = embedding
+        self.vectors = np.load(path / 'vectors.npy', mmap_mode='r')
+        self.offsets = np.load(path / 'offsets.npy', mmap_mode='r')
+        with open(path / 'chunks.bin', 'rb') as f:
+            # mmap can't map an empty file
+            self.chunks = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+        with open(path / 'metadata.json') as f:
+            self.metadatas = json.load(f)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def chunk(self, i):
+        return LCDocument(
+            page_content=self.chunks[self.offsets[i]:self.offsets[i + 1]].decode('utf-8'),
+            metadata=self.metadatas[i] or {},
+        )
+
+    def rank(self, embedding, k, scores=None):
+        """Indices of the k chunks most similar to the embedding, best first."""
+        if not len(self):
+            return []
+        if scores is None:
+            scores = self.scores(embedding)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [int(i) for i in top[np.argsort(-scores[top])]]
+
+    def scores(self, embedding):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        return self.vectors @ (embedding / np.linalg.norm(embedding))
+
+    def search(self, embedding, k):
+        if not len(self):
+            return []
+        scores = self.scores(embedding)
+        return [(self.chunk(i), float(scores[i])) for i in self.rank(embedding, k, scores)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.search(self.embedding.embed_query(query), k)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    async def asimilarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.search(await self.embedding.aembed_query(query), k)]
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError('The index is read-only, rebuild it from the documents instead')
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError('The index is read-only, rebuild it from the documents instead')
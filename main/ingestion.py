@@ -0,0 +1,93 @@
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.conf import settings
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from main.index import build_index, is_built
+from main.residencies import RESIDENCY_INDEX_NAME, ResidencyIndex
+
+# Kept in the index version directory, so a worker loading a version gets the texts and residency index built with it
+PRE_SPLITTED_TEXTS_NAME = 'texts.pkl'
+TEXTS_NAME = 'texts_splitted.pkl'
+# What workers need to know about the chunks without loading them, like the tokens the largest one takes
+STATS_NAME = 'stats.pkl'
+VERSION_FILES = [PRE_SPLITTED_TEXTS_NAME, TEXTS_NAME, RESIDENCY_INDEX_NAME, STATS_NAME]
+PARSED_CACHE_DIR = settings.MEDIA_ROOT / 'documents/parsed'
+
+
+def parse_file(doc_type, path):
+    from main.models import Document
+    return Document.parse_file(doc_type, path)
+
+
+def ingest(documents, workers=None, progress=None):
+    """
+    Turns documents into the pre-split and split texts.
+    Loader output is cached by file content hash, so only new or changed files are parsed, in a pool
+    of processes. progress, if given, is called with each document and either 'cached' or 'parsed'.
+    """
+    documents = list(documents)
+    os.makedirs(PARSED_CACHE_DIR, exist_ok=True)
+    file_hashes = {document.pk: document.file_hash() for document in documents}
+
+    parsed = {}
+    to_parse = []
+    for document in documents:
+        cache_path = PARSED_CACHE_DIR / f'{file_hashes[document.pk]}.pkl'
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                parsed[document.pk] = pickle.load(f)
+            if progress:
+                progress(document, 'cached')
+        else:
+            to_parse.append(document)
+
+    if to_parse:
+        # Spawned rather than forked, as this may run inside a worker with an event loop and threads
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=django.setup) as pool:
+            futures = {pool.submit(parse_file, document.doc_type, document.doc_file.path): document for document in to_parse}
+            for future in as_completed(futures):
+                document = futures[future]
+                parsed[document.pk] = future.result()
+                with open(PARSED_CACHE_DIR / f'{file_hashes[document.pk]}.pkl', 'wb') as f:
+                    pickle.dump(parsed[document.pk], f)
+                if progress:
+                    progress(document, 'parsed')
+
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1600, chunk_overlap=350, separators=['\n', '\.'])
+    pre_splitted_texts = []
+    texts = []
+    for document in documents:
+        processed_txt = document.extract_links(parsed[document.pk])
+        for doc in processed_txt:
+            doc.metadata.update(document_id=document.pk, document_name=document.name, file_hash=file_hashes[document.pk])
+        pre_splitted_texts.extend(processed_txt)
+        texts.extend(text_splitter.split_documents(processed_txt))
+
+    return pre_splitted_texts, texts
+
+
+def build_version(documents, workers=None, progress=None):
+    """
+    Ingests the documents and builds the index version of their texts, which keeps the texts, the residency
+    index and their stats too. Needs the build lock held. Returns the version and the split texts.
+    """
+    from main.genie import get_encoding
+    pre_splitted_texts, texts = ingest(documents, workers, progress)
+    encoding = get_encoding()
+    _, version = build_index(texts, {
+        PRE_SPLITTED_TEXTS_NAME: pre_splitted_texts,
+        TEXTS_NAME: texts,
+        RESIDENCY_INDEX_NAME: ResidencyIndex.build(pre_splitted_texts),
+        STATS_NAME: {'max_chunk_tokens': max((len(encoding.encode(text.page_content)) for text in texts), default=0)},
+    })
+    return version, texts
+
+
+def version_built(version):
+    return is_built(version, VERSION_FILES)
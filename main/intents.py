@@ -0,0 +1,62 @@
+from collections import Counter
+
+from chatbot.utils import fold_text
+
+# Only Latin spellings without diacritics are needed, as messages are folded the same way
+CONTACT_KEYWORDS = 'kontaktiram kontaktiraj kontakt kontaktirajte kontaktira'\
+                   ' zboruvam zboruvaj zboruvanje zboruvajte zboruva'\
+                   ' tipkam tipkaj tipkanje tipkajte tipka'\
+                   ' pisuvam pisuvaj pisuvanje pisuvajte pisuva'\
+                   ' prasam prasaj prasanje prasajte prasa'.split(' ')
+AGENT_KEYWORDS = 'agenta agent agenti agentom'\
+                 ' operator operatori operatorot'\
+                 ' covek covekot'.split(' ')
+
+
+def trigrams(text):
+    return Counter(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class IntentMatcher:
+    """
+    Scores a message against each intent as the best trigram similarity (Jaccard) it has with any of
+    the intent's keywords. Keyword trigrams are indexed once, so a message is scored in a single pass
+    over its own trigrams, however many intents and keywords are registered.
+    """
+
+    def __init__(self):
+        self.keywords = []
+        self.index = {}
+        self.thresholds = {}
+
+    def register(self, intent, keywords, threshold=0.05):
+        self.thresholds[intent] = threshold
+        for keyword in {fold_text(keyword) for keyword in keywords}:
+            keyword_trigrams = trigrams(keyword)
+            if not keyword_trigrams:
+                continue
+            self.keywords.append((intent, sum(keyword_trigrams.values())))
+            for trigram, count in keyword_trigrams.items():
+                self.index.setdefault(trigram, []).append((len(self.keywords) - 1, count))
+
+    def scores(self, message):
+        message_trigrams = trigrams(fold_text(message))
+        total = sum(message_trigrams.values())
+        shared = Counter()
+        for trigram, count in message_trigrams.items():
+            for keyword, keyword_count in self.index.get(trigram, ()):
+                shared[keyword] += min(count, keyword_count)
+
+        scores = dict.fromkeys(self.thresholds, 0)
+        for keyword, intersection in shared.items():
+            intent, size = self.keywords[keyword]
+            scores[intent] = max(scores[intent], intersection / (total + size - intersection))
+        return scores
+
+    def detect(self, message):
+        return {intent for intent, score in self.scores(message).items() if score > self.thresholds[intent]}
+
+
+intent_matcher = IntentMatcher()
+intent_matcher.register('contact', CONTACT_KEYWORDS)
+intent_matcher.register('agent', AGENT_KEYWORDS)
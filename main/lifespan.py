@@ -0,0 +1,32 @@
+from .admission import admission_queue
+from .genie import Genie
+from .panel_events import panel_event_bus
+from .reload import reloader
+from .scraper import gallery_scraper
+
+
+class LifespanApp:
+    """
+    Starts building the Genie, the gallery scraper, the admission queue and the knowledge base reloader as soon
+    as the worker boots, instead of on the first visitor.
+    """
+
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Not awaited, so the worker accepts connections (and reports "warming" on /health/) meanwhile
+                Genie.start_warm_up()
+                gallery_scraper.ensure_worker()
+                admission_queue.ensure_worker()
+                panel_event_bus.start()
+                reloader.ensure_worker()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if Genie.warm_up_task:
+                    Genie.warm_up_task.cancel()
+                await gallery_scraper.close()
+                await admission_queue.close()
+                await reloader.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
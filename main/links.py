@@ -0,0 +1,52 @@
+import re
+
+from .redis_init import redis_conn
+
+CHANGES_CHANNEL = 'links:changed'
+
+
+def publish_changes(link_ids):
+    """Tells every worker (through the reloader) to reload the given links."""
+    if link_ids:
+        redis_conn.publish(CHANGES_CHANNEL, ','.join(map(str, link_ids)))
+
+
+class LinkCache:
+    """
+    Process-wide map of link ids to URLs, so answers are resolved without a database round-trip.
+    Fetched whenever a Genie is built and put to use along with it, and kept up to date in every worker by the
+    changes published in Redis.
+    """
+
+    def __init__(self):
+        self.urls = {}
+        self.regex = None
+
+    @staticmethod
+    def fetch():
+        from .models import Link
+        return dict(Link.objects.values_list('pk', 'url'))
+
+    def use(self, urls):
+        from .models import LINK_REGEX
+        self.regex = re.compile(LINK_REGEX)
+        self.urls = urls
+
+    def refresh(self, link_ids):
+        from .models import Link
+        urls = dict(Link.objects.filter(pk__in=link_ids).values_list('pk', 'url'))
+        for link_id in link_ids:
+            if link_id in urls:
+                self.urls[link_id] = urls[link_id]
+            else:
+                self.urls.pop(link_id, None)
+        return urls
+
+    def resolve(self, text):
+        if self.regex is None:
+            return text
+        # Unknown ids are left as they are, like before
+        return self.regex.sub(lambda match: self.urls.get(int(match.group(1)), match.group()), text)
+
+
+link_cache = LinkCache()
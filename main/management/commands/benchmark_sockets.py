@@ -0,0 +1,117 @@
+import asyncio
+import json
+import random
+import time
+
+import aiohttp
+from django.core.management.base import BaseCommand, CommandError
+
+from main.consumers import MESSAGE_LIMIT_PER_IP
+from main.genie import WARMING_ANSWER
+
+PANEL_ROUNDS = 10
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures how long the server takes to answer with many sockets open at once: the panel answering '
+        'fetch_messages, or the chat answering send_message from the answer cache. '
+        'Run it against a server on each revision to compare them.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=['fetch_messages', 'send_message'])
+        parser.add_argument('--session-id', type=int, help='Chat session whose messages are fetched')
+        parser.add_argument('--question', default='Koje rezidencije imate?', help='Message the chat is sent')
+        parser.add_argument('--host', default='ws://localhost:8000')
+        parser.add_argument('--cookie', help='sessionid cookie of a logged in agent')
+        parser.add_argument('--sockets', type=int, default=200)
+        parser.add_argument(
+            '--rounds', type=int,
+            help=f'Requests per socket, by default {PANEL_ROUNDS} for the panel and the message limit for the chat'
+        )
+
+    def handle(self, *args, **options):
+        if options['scenario'] == 'fetch_messages':
+            if options['session_id'] is None or not options['cookie']:
+                raise CommandError('fetch_messages needs --session-id and --cookie')
+            options['rounds'] = options['rounds'] or PANEL_ROUNDS
+            latencies = asyncio.run(self.benchmark_panel(options))
+        else:
+            options['rounds'] = options['rounds'] or MESSAGE_LIMIT_PER_IP
+            if options['rounds'] > MESSAGE_LIMIT_PER_IP:
+                raise CommandError(f'The chat answers at most {MESSAGE_LIMIT_PER_IP} messages per socket')
+            latencies = asyncio.run(self.benchmark_chat(options))
+        latencies.sort()
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000
+
+        self.stdout.write(
+            f"{len(latencies)} {options['scenario']} requests over {options['sockets']} sockets: "
+            f'p50 {percentile(50):.1f} ms, p95 {percentile(95):.1f} ms, p99 {percentile(99):.1f} ms'
+        )
+
+    @staticmethod
+    async def run_sockets(options, connect, request, **session_kwargs):
+        """
+        Opens the sockets with connect(session, i) and times request(ws) on all of them at once, options['rounds']
+        times on each. Returns the latencies.
+        """
+        latencies = []
+        # Every socket waits for the others to connect, so the requests really are concurrent
+        connected = asyncio.Barrier(options['sockets'])
+
+        async def socket(session, i):
+            async with connect(session, i) as ws:
+                await connected.wait()
+                for _ in range(options['rounds']):
+                    start = time.perf_counter()
+                    await request(ws)
+                    latencies.append(time.perf_counter() - start)
+
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0), **session_kwargs) as session:
+            await asyncio.gather(*(socket(session, i) for i in range(options['sockets'])))
+        return latencies
+
+    async def benchmark_panel(self, options):
+        data = json.dumps({'command': 'fetch_messages', 'session_id': options['session_id']})
+
+        async def request(ws):
+            await ws.send_str(data)
+            # Skip anything broadcast to the panel meanwhile
+            while json.loads((await ws.receive()).data).get('command') != 'fetch_messages':
+                pass
+
+        return await self.run_sockets(
+            options, lambda session, i: session.ws_connect(f"{options['host']}/ws/panel/"), request,
+            cookies={'sessionid': options['cookie']},
+        )
+
+    async def benchmark_chat(self, options):
+        data = json.dumps({'command': 'send_message', 'message': options['question']})
+        # The message limit is per IP, so every socket gets its own, and each run its own range of them
+        network = random.randrange(256)
+
+        def connect(session, i):
+            return session.ws_connect(
+                f"{options['host']}/ws/chat/", headers={'X-Forwarded-For': f'10.{network}.{i // 256}.{i % 256}'}
+            )
+
+        async def request(ws):
+            await ws.send_str(data)
+            # Skip the other frames, like the queue position
+            while True:
+                response = json.loads((await ws.receive()).data)
+                if 'message' in response:
+                    return response['message']
+                if response.get('exceeded_limit'):
+                    raise CommandError('Hit the message limit, try again with fewer rounds')
+
+        async with aiohttp.ClientSession() as session:
+            # Asked once first, so the answer is in the cache and the timed ones don't wait on OpenAI
+            async with connect(session, options['sockets']) as ws:
+                while await request(ws) == WARMING_ANSWER:
+                    await asyncio.sleep(1)
+
+        return await self.run_sockets(options, connect, request)
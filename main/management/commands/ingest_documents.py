@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.index import build_lock
+from main.ingestion import build_version, ingest
+from main.models import Document
+from main.reload import publish_version
+
+
+class Command(BaseCommand):
+    help = 'Builds a version of the texts, residency index and embedding index from all documents, re-parsing only files that changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help='Number of processes parsing documents (defaults to the number of CPUs)')
+        parser.add_argument('--no-embed', action='store_true', help="Only parse the documents, so the next build finds them cached")
+
+    def handle(self, *args, **options):
+        documents = list(Document.objects.all())
+        done = 0
+        started = time.monotonic()
+
+        def progress(document, status):
+            nonlocal done
+            done += 1
+            self.stdout.write(f'[{done}/{len(documents)}] {document.name}: {status}')
+
+        if options['no_embed']:
+            texts = ingest(documents, options['workers'], progress)[1]
+            self.stdout.write(f'{len(texts)} chunks from {len(documents)} documents in {time.monotonic() - started:.1f}s')
+            self.stdout.write(self.style.SUCCESS('Done, the parsed documents are cached for the next build'))
+            return
+        # Not alongside a worker doing the same
+        with build_lock():
+            version, texts = build_version(documents, options['workers'], progress)
+        self.stdout.write(f'{len(texts)} chunks from {len(documents)} documents in {time.monotonic() - started:.1f}s')
+        publish_version(version)
+        self.stdout.write(self.style.SUCCESS(f'Done, the workers are switching to version {version}'))
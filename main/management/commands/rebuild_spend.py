@@ -0,0 +1,38 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from django.db.models.functions import TruncDate
+
+from main.costs import DAY_KEY, MONTH_KEY, MICROS, cost_micros
+from main.models import ChatMessage
+from main.redis_init import redis_conn
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the daily and monthly spend counters from the tokens stored with chat messages'
+
+    def handle(self, *args, **options):
+        days = Counter()
+        usage = (ChatMessage.objects.exclude(model='').annotate(day=TruncDate('created_at'))
+                 .values('day', 'model').annotate(prompt=Sum('prompt_tokens'), completion=Sum('completion_tokens')))
+        for row in usage:
+            days[row['day']] += cost_micros(row['model'], row['prompt'], row['completion'])
+        months = Counter()
+        for day, spent in days.items():
+            months[day.strftime('%Y-%m')] += spent
+
+        with redis_conn.pipeline(transaction=True) as pipe:
+            for key in redis_conn.scan_iter((DAY_KEY % '*').encode()):
+                pipe.delete(key)
+            for key in redis_conn.scan_iter((MONTH_KEY % '*').encode()):
+                pipe.delete(key)
+            for day, spent in days.items():
+                pipe.set(DAY_KEY % day.strftime('%Y-%m-%d'), spent, ex=40 * 86400)
+            for month, spent in months.items():
+                pipe.set(MONTH_KEY % month, spent, ex=400 * 86400)
+            pipe.execute()
+
+        for month, spent in sorted(months.items()):
+            self.stdout.write(f'{month}: ${spent / MICROS:.2f}')
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt spend for {len(days)} days'))
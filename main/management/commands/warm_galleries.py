@@ -0,0 +1,40 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from main.models import Link
+from main.scraper import gallery_scraper, get_stale_link_ids
+
+
+class Command(BaseCommand):
+    help = 'Scrapes residency galleries of all links, so visitors never wait for them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stale', action='store_true', help='Only scrape galleries that are missing or out of date')
+
+    def handle(self, *args, **options):
+        asyncio.run(self.warm(options['stale']))
+
+    async def warm(self, stale):
+        if stale:
+            link_ids = await get_stale_link_ids()
+        else:
+            link_ids = [link_id async for link_id in Link.objects.values_list('pk', flat=True)]
+
+        done = 0
+
+        async def scrape(link_id):
+            nonlocal done
+            try:
+                img_links = await gallery_scraper.scrape(link_id)
+                self.stdout.write(f'[{done + 1}/{len(link_ids)}] Link {link_id}: {len(img_links or [])} images')
+            except Exception as e:
+                self.stderr.write(f'[{done + 1}/{len(link_ids)}] Link {link_id}: {e}')
+            done += 1
+
+        try:
+            # The client's connection limits keep this from hammering any single host
+            await asyncio.gather(*(scrape(link_id) for link_id in link_ids))
+        finally:
+            await gallery_scraper.close()
+        self.stdout.write(self.style.SUCCESS(f'Scraped {len(link_ids)} galleries'))
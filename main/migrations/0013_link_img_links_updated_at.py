@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_visitorinfo_email'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='link',
+            name='img_links_updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.3 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_link_img_links_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='completion_tokens',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='model',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='prompt_tokens',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
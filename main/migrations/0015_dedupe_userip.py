@@ -0,0 +1,26 @@
+from django.db import migrations
+from django.db.models import Count, Max, Min
+
+
+def dedupe_user_ips(apps, schema_editor):
+    # ip_address becomes unique, so sessions of duplicate rows are moved to the oldest one
+    UserIP = apps.get_model('main', 'UserIP')
+    ChatSession = apps.get_model('main', 'ChatSession')
+    duplicates = (UserIP.objects.values('ip_address').annotate(count=Count('pk'), keep=Min('pk'), latest=Max('latest_message_time'))
+                  .filter(count__gt=1))
+    for duplicate in duplicates:
+        others = UserIP.objects.filter(ip_address=duplicate['ip_address']).exclude(pk=duplicate['keep'])
+        ChatSession.objects.filter(user_ip__in=others).update(user_ip_id=duplicate['keep'])
+        others.delete()
+        UserIP.objects.filter(pk=duplicate['keep']).update(latest_message_time=duplicate['latest'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_chatmessage_tokens'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_user_ips, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.3 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_dedupe_userip'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='userip',
+            name='ip_address',
+            field=models.GenericIPAddressField(unique=True),
+        ),
+        migrations.AlterField(
+            model_name='chatsession',
+            name='sid',
+            field=models.CharField(db_index=True, max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name='chatsession',
+            index=models.Index(fields=['-id'], name='chatsession_id_desc'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['session', 'id'], name='chatmessage_session_id'),
+        ),
+    ]
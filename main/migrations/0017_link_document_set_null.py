@@ -0,0 +1,19 @@
+# Generated by Django 4.2.3 on 2026-10-18 21:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0016_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='link',
+            name='document',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='main.document'),
+        ),
+    ]
@@ -1,8 +1,9 @@
+import hashlib
 import os
 import re
 
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
 from langchain.document_loaders import (
     UnstructuredCSVLoader,
     UnstructuredExcelLoader,
@@ -13,6 +14,8 @@ from langchain.document_loaders import (
 )
 from langchain.docstore.document import Document as LCDocument
 
+from .links import publish_changes
+
 
 URL_PATTERN = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
 LINK_PLACEHOLDER = 'link://%i'
@@ -41,45 +44,72 @@ class Document(models.Model):
         'docx': UnstructuredWordDocumentLoader,
     }
 
-    def get_loader(self, mode='elements', strategy='fast'):
-        if self.doc_type == 'pdf':
-            return self.LOADER_MAP['pdf'](self.doc_file.path)
-        elif self.doc_type == 'txt':
-            return self.LOADER_MAP['txt'](self.doc_file.path, autodetect_encoding=True)
+    @classmethod
+    def get_file_loader(cls, doc_type, path, mode='elements', strategy='fast'):
+        if doc_type == 'pdf':
+            return cls.LOADER_MAP['pdf'](path)
+        elif doc_type == 'txt':
+            return cls.LOADER_MAP['txt'](path, autodetect_encoding=True)
         else:
-            return self.LOADER_MAP[self.doc_type](self.doc_file.path, mode=mode, strategy=strategy)
+            return cls.LOADER_MAP[doc_type](path, mode=mode, strategy=strategy)
 
-    def preprocess_text(self):
-        loader = self.get_loader()
-        document = loader.load()
+    def get_loader(self, mode='elements', strategy='fast'):
+        return self.get_file_loader(self.doc_type, self.doc_file.path, mode, strategy)
+
+    def file_hash(self):
+        sha = hashlib.sha256()
+        with open(self.doc_file.path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    @classmethod
+    def parse_file(cls, doc_type, path):
+        """Runs the loader over a file. Doesn't touch the database, so it can run in another process."""
+        document = cls.get_file_loader(doc_type, path).load()
         docs = []
         if len(document) == 1:
             for txt in document[0].page_content.split('\n'):
                 docs.append(LCDocument(page_content=txt + '\n', metadata=document[0].metadata))
         else:
             docs = document
+        return docs
+
+    def extract_links(self, docs):
+        """
+        Replaces URLs with link placeholders. Each URL gets a single Link row, shared across documents and
+        reused on re-ingestion, so placeholders (and the chunks and images depending on them) stay the same.
+        """
+        urls = sorted({url for doc in docs for url in URL_PATTERN.findall(doc.page_content)})
+        # With duplicates left over from older ingestions, the oldest row wins
+        link_ids = dict(Link.objects.filter(url__in=urls).order_by('-pk').values_list('url', 'pk'))
+        new_links = Link.objects.bulk_create([Link(document=self, url=url) for url in urls if url not in link_ids])
+        link_ids.update((link.url, link.pk) for link in new_links)
+        # bulk_create sends no signals
+        publish_changes([link.pk for link in new_links])
         for doc in docs:
-            url_pattern = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
-            links = url_pattern.findall(doc.page_content)
-            for link in links:
-                l_obj = Link.objects.create(document=self, url=link)
-                placeholder = LINK_PLACEHOLDER % l_obj.pk
-                doc.page_content = doc.page_content.replace(link, placeholder)
+            doc.page_content = URL_PATTERN.sub(lambda match: LINK_PLACEHOLDER % link_ids[match.group()], doc.page_content)
         return docs
 
+    def preprocess_text(self):
+        return self.extract_links(self.parse_file(self.doc_type, self.doc_file.path))
+
 class Link(models.Model):
-    document = models.ForeignKey(Document, on_delete=models.CASCADE)
+    # The document the URL was first found in. Links are shared by every document with the same URL, so they
+    # outlive it
+    document = models.ForeignKey(Document, on_delete=models.SET_NULL, null=True, blank=True)
     url = models.URLField(max_length=2000)
     img_links = models.TextField(null=True, blank=True)
+    img_links_updated_at = models.DateTimeField(null=True, blank=True)
 
 
 class UserIP(models.Model):
-    ip_address = models.GenericIPAddressField()
+    ip_address = models.GenericIPAddressField(unique=True)
     latest_message_time = models.DateTimeField(null=True, blank=True)
 
 class ChatSession(models.Model):
     user_ip = models.ForeignKey(UserIP, on_delete=models.SET_NULL, null=True, blank=True, related_name='chat_sessions')
-    sid = models.CharField(max_length=50)
+    sid = models.CharField(max_length=50, db_index=True)
     name = models.CharField(max_length=255, null=True, blank=True)
     is_terminated = models.BooleanField(default=False)
     info_provided = models.BooleanField(default=False)
@@ -88,6 +118,9 @@ class ChatSession(models.Model):
     human_agent = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL)
     agent_requested = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [models.Index(fields=['-id'], name='chatsession_id_desc')]
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -100,12 +133,30 @@ class ChatSession(models.Model):
             'human_agent': self.human_agent.id if self.human_agent else None,
         }
 
+    def add_message(self, message, response, **fields):
+        """
+        Stores a message and makes it the session's last one, without touching the session's other fields.
+        The session's name is read back, as it may have been renamed in the panel meanwhile.
+        """
+        with transaction.atomic():
+            chat_message = ChatMessage.objects.create(session=self, message=message, response=response, **fields)
+            ChatSession.objects.filter(pk=self.pk).update(last_message=chat_message)
+            self.name = ChatSession.objects.values_list('name', flat=True).get(pk=self.pk)
+        self.last_message = chat_message
+        return chat_message
+
 class ChatMessage(models.Model):
     session = models.ForeignKey(ChatSession, related_name='messages', on_delete=models.CASCADE)
     message = models.TextField(null=True, blank=True)
     response = models.TextField(null=True, blank=True)
     file = models.FileField(upload_to='attachments/', null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    model = models.CharField(max_length=50, blank=True)
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    completion_tokens = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=['session', 'id'], name='chatmessage_session_id')]
 
     def to_dict(self):
         return {
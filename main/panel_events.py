@@ -0,0 +1,64 @@
+import asyncio
+import traceback
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .serialization import encode_all
+
+SUMMARY_GROUP = 'panel.summary'
+SESSION_GROUP = 'panel.session.%i'
+
+
+def group_for(session_id):
+    return SUMMARY_GROUP if session_id is None else SESSION_GROUP % session_id
+
+
+class PanelEventBus:
+    """
+    Sends events to the panel in batches: whatever a worker publishes within PANEL_BATCH_WINDOW seconds goes
+    out as one channel layer message per group. Agents get the summary stream (new sessions and activity in
+    them) and the full events of only the sessions they subscribed to.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.pending = {}
+        self.flush_task = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+
+    def publish(self, event, session_id=None):
+        """Queues an event for the session's subscribers, or for the summary stream. Has to be called on the event loop."""
+        if self.loop is None:
+            self.start()
+        self.pending.setdefault(group_for(session_id), []).append(event)
+        if self.flush_task is None:
+            self.flush_task = self.loop.create_task(self.flush())
+
+    def publish_threadsafe(self, event, session_id=None):
+        """Like publish, for sync code. Outside of a worker with a running event loop, the event is sent right away."""
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.publish, event, session_id)
+        else:
+            async_to_sync(get_channel_layer().group_send)(group_for(session_id), self.batch([event]))
+
+    @staticmethod
+    def batch(events):
+        return {'type': 'panel.batch', 'encoded': encode_all({'command': 'batch', 'events': events})}
+
+    async def flush(self):
+        await asyncio.sleep(settings.PANEL_BATCH_WINDOW)
+        pending, self.pending = self.pending, {}
+        self.flush_task = None
+        channel_layer = get_channel_layer()
+        for group, events in pending.items():
+            try:
+                await channel_layer.group_send(group, self.batch(events))
+            except Exception:
+                traceback.print_exc()
+
+
+panel_event_bus = PanelEventBus()
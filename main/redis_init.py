@@ -1,51 +1,111 @@
 import os
 import redis
+from redis import asyncio as aioredis
 
 redis_conn = redis.Redis(host=os.environ.get('REDIS_HOST'), port=int(os.environ.get('REDIS_PORT')), db=int(os.environ.get('REDIS_DB')))
+async_redis_conn = aioredis.Redis(host=os.environ.get('REDIS_HOST'), port=int(os.environ.get('REDIS_PORT')), db=int(os.environ.get('REDIS_DB')))
+# For blocking commands (BLPOP and the like), which would otherwise run into the client's socket timeout
+# (5 seconds by default in newer redis-py) and be retried from the start over and over
+blocking_redis_conn = aioredis.Redis(
+    host=os.environ.get('REDIS_HOST'), port=int(os.environ.get('REDIS_PORT')), db=int(os.environ.get('REDIS_DB')),
+    socket_timeout=None,
+)
 
 GLOBAL_TOKEN_LIMIT_PER_MINUTE = 90000
-# Define the Lua script
-lua_script = f"""
--- Get the current timestamp from Redis TIME command
-local redis_time = redis.call('TIME')
-local now = redis_time[1] + redis_time[2]/1000000
-
--- If update is true, attempt to add the new tokens to Redis
-if ARGV[1] == 'true' and tonumber(ARGV[2]) > 0 then
-  -- Generate a unique member by appending the current timestamp to the token count
-  local member = tostring(ARGV[2]) .. ":" .. tostring(now)
-  redis.call("ZADD", "tokens", now, member)
-end
-
--- Remove tokens older than 60 seconds
-redis.call("ZREMRANGEBYSCORE", "tokens", "-inf", now - 60)
+TOKEN_LIMIT_KEYS = ['tokens:buckets', 'tokens:total', 'tokens:tail']
+RATE_LIMITED, RESERVED, OVER_BUDGET = 0, 1, -1
+# Tokens used in the last minute, kept in per-second buckets (a hash) with a running total and the oldest
+# bucket still counted, so a call only drops the buckets that left the window since the previous one.
+# The month's and day's spend (KEYS[4] and KEYS[5], in micros) are checked and counted in the same call.
+# ARGV[1] is 'reserve' (ARGV[2] tokens costing ARGV[4], if they fit the limit and the ARGV[5] budget) or
+# 'reconcile' (ARGV[2] tokens costing ARGV[4] actually used for the ARGV[7] tokens reserved in bucket ARGV[6]).
+# Returns {status, bucket, seconds until enough tokens free up, spent this month}.
+token_limit_script = async_redis_conn.register_script("""
+local window = 60
+local now = tonumber(redis.call('TIME')[1])
+local start = now - window + 1
+local tokens = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+local total = tonumber(redis.call('GET', KEYS[2]) or 0)
+local tail = tonumber(redis.call('GET', KEYS[3]) or start)
 
--- Get all tokens in the last 60 seconds
-local tokens = redis.call("ZRANGE", "tokens", 0, -1)
-local token_count = 0
-for _, token in ipairs(tokens) do
-  -- Extract the token count from the member string
-  local token_value = tonumber(string.match(token, "^(%d+):"))
-  token_count = token_count + token_value
+if start - tail >= window then
+  redis.call('DEL', KEYS[1])
+  total = 0
+else
+  for second = tail, start - 1 do
+    total = total - tonumber(redis.call('HGET', KEYS[1], second) or 0)
+    redis.call('HDEL', KEYS[1], second)
+  end
 end
+tail = math.max(tail, start)
 
-local limit = {GLOBAL_TOKEN_LIMIT_PER_MINUTE}
--- If token count is within the limit, return 0
-if token_count <= limit then
-  return 0
+local cost = tonumber(ARGV[4])
+local spent = tonumber(redis.call('GET', KEYS[4]) or 0)
+local result = {1, now, 0, spent}
+if ARGV[1] == 'reserve' then
+  local budget = tonumber(ARGV[5])
+  if budget > 0 and cost > 0 and spent + cost > budget then
+    result = {-1, 0, 0, spent}
+  elseif total + tokens > limit then
+    -- Find the bucket whose expiry frees up enough of the limit
+    local needed = total + tokens - limit
+    local remaining_secs = window
+    for second = tail, now do
+      needed = needed - tonumber(redis.call('HGET', KEYS[1], second) or 0)
+      if needed <= 0 then
+        remaining_secs = second + window - now
+        break
+      end
+    end
+    result = {0, 0, remaining_secs, spent}
+  elseif tokens > 0 then
+    redis.call('HINCRBY', KEYS[1], now, tokens)
+    total = total + tokens
+  end
+else
+  local bucket = tonumber(ARGV[6])
+  if bucket >= tail then
+    redis.call('HINCRBY', KEYS[1], bucket, tokens - tonumber(ARGV[7]))
+    total = total + tokens - tonumber(ARGV[7])
+  else
+    -- The reservation has already left the window, so count the tokens from now on
+    redis.call('HINCRBY', KEYS[1], now, tokens)
+    total = total + tokens
+  end
+  spent = redis.call('INCRBY', KEYS[4], cost)
+  redis.call('INCRBY', KEYS[5], cost)
+  redis.call('EXPIRE', KEYS[4], 400 * 86400)
+  redis.call('EXPIRE', KEYS[5], 40 * 86400)
+  result[4] = spent
 end
 
--- Calculate the delay using exponential backoff with jitter
-local tokens_over_limit = token_count - limit
-local delay_factor = math.ceil(tokens_over_limit / limit)
-local delay = math.random() * math.pow(2, delay_factor)
+redis.call('SET', KEYS[2], total, 'EX', window * 2)
+redis.call('SET', KEYS[3], tail, 'EX', window * 2)
+redis.call('EXPIRE', KEYS[1], window * 2)
+return result
+""")
 
--- Cap the delay at a maximum value
-local max_delay = 60
-delay = math.min(delay, max_delay)
+# Sliding window of messages per IP, kept as a sorted set of timestamps. With ARGV[1] == 'true' the message is
+# also recorded, unless the limit has already been reached. Returns the number of messages in the window
+# before this one and the seconds until the oldest of them leaves it.
+message_limit_script = async_redis_conn.register_script("""
+local redis_time = redis.call('TIME')
+local now = redis_time[1] + redis_time[2]/1000000
+local limit = tonumber(ARGV[2])
+local window = tonumber(ARGV[3])
 
-return delay
-"""
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+local count = redis.call('ZCARD', KEYS[1])
+if ARGV[1] == 'true' and count < limit then
+  redis.call('ZADD', KEYS[1], now, ARGV[4])
+  redis.call('EXPIRE', KEYS[1], window)
+end
 
-# Register the Lua script
-lua_script = redis_conn.register_script(lua_script)
+local remaining_secs = 0
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if oldest[2] then
+  remaining_secs = math.max(0, math.ceil(oldest[2] + window - now))
+end
+return {count, remaining_secs}
+""")
@@ -0,0 +1,187 @@
+import asyncio
+import traceback
+
+from channels.db import DatabaseSyncToAsync, database_sync_to_async
+from django.conf import settings
+from redis.exceptions import LockError
+
+from .index import BUILD_TIMEOUT, build_lock, collect_garbage
+from .ingestion import build_version, version_built
+from .links import CHANGES_CHANNEL, link_cache
+from .redis_init import async_redis_conn, redis_conn
+
+REQUESTED_KEY = 'knowledge_base:requested'
+BUILT_KEY = 'knowledge_base:built'
+VERSION_KEY = 'knowledge_base:version'
+REBUILD_LOCK_KEY = 'knowledge_base:rebuild'
+REBUILD_CHANNEL = 'knowledge_base:rebuild'
+VERSION_CHANNEL = 'knowledge_base:version'
+RECONNECT_DELAY = 5
+
+
+def request_rebuild():
+    """Asks a worker to rebuild the knowledge base. Counted in Redis, so a rebuild nobody was around to hear still happens."""
+    redis_conn.incr(REQUESTED_KEY)
+    redis_conn.publish(REBUILD_CHANNEL, 1)
+
+
+def publish_version(version):
+    redis_conn.set(VERSION_KEY, version)
+    redis_conn.publish(VERSION_CHANNEL, version)
+
+
+def published_version():
+    version = redis_conn.get(VERSION_KEY)
+    return version.decode() if version is not None else None
+
+
+def ensure_version():
+    """
+    The published version of the knowledge base, or if there's none yet (or its files are gone), one built from
+    the documents and published. On a cold start every worker gets here at once, and only one of them should
+    ingest and embed, the rest wait for it and load what it built.
+    """
+    version = published_version()
+    if version is None or not version_built(version):
+        with build_lock():
+            version = published_version()
+            if version is None or not version_built(version):
+                from .models import Document
+                version = build_version(Document.objects.all())[0]
+                publish_version(version)
+    return version
+
+
+def rebuild():
+    from .models import Document
+    with build_lock():
+        return build_version(Document.objects.all())[0]
+
+
+class Reloader:
+    """
+    Keeps every worker on the latest knowledge base without restarts. When documents change, one worker
+    rebuilds the texts and the index (a new version directory, with only new chunks embedded) and publishes
+    its version, upon which every worker builds a Genie on it in the background and swaps it in, answering
+    with the old one meanwhile. Changed links are reloaded the same way, without a rebuild.
+    """
+
+    def __init__(self):
+        self.worker = None
+        self.build_task = None
+        self.reload_task = None
+        # The latest published version, which reload_task brings this worker to
+        self.version = None
+        self.tasks = set()
+
+    def ensure_worker(self):
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self):
+        for task in (self.worker, self.build_task, self.reload_task, *self.tasks):
+            if task is not None:
+                task.cancel()
+
+    def run_in_background(self, coro):
+        # Kept referenced until it's done, so it isn't garbage collected
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self):
+        while True:
+            try:
+                async with async_redis_conn.pubsub() as pubsub:
+                    await pubsub.subscribe(REBUILD_CHANNEL, VERSION_CHANNEL, CHANGES_CHANNEL)
+                    # Catch up on what was published while this worker wasn't listening
+                    self.ensure_build()
+                    version = await async_redis_conn.get(VERSION_KEY)
+                    if version is not None:
+                        self.ensure_reload(version.decode())
+                    async for message in pubsub.listen():
+                        if message['type'] != 'message':
+                            continue
+                        channel = message['channel'].decode()
+                        if channel == REBUILD_CHANNEL:
+                            self.ensure_build()
+                        elif channel == CHANGES_CHANNEL:
+                            self.run_in_background(self.refresh_links(map(int, message['data'].decode().split(','))))
+                        else:
+                            self.ensure_reload(message['data'].decode())
+            except Exception:
+                traceback.print_exc()
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    def ensure_build(self):
+        if self.build_task is None or self.build_task.done():
+            self.build_task = asyncio.get_running_loop().create_task(self.build())
+
+    async def build(self):
+        """Rebuilds until the last requested change is in, if no other worker is at it."""
+        lock = async_redis_conn.lock(REBUILD_LOCK_KEY, timeout=BUILD_TIMEOUT)
+        if not await lock.acquire(blocking=False):
+            return
+        try:
+            while True:
+                requested = await async_redis_conn.get(REQUESTED_KEY)
+                if requested is None or requested == await async_redis_conn.get(BUILT_KEY):
+                    break
+                # Documents tend to be changed a few at a time, so let the rest come in first
+                await asyncio.sleep(settings.REBUILD_DELAY)
+                requested = await async_redis_conn.get(REQUESTED_KEY)
+                # Off the thread the worker runs its other database calls in, as this takes a while
+                version = await DatabaseSyncToAsync(rebuild, thread_sensitive=False)()
+                await async_redis_conn.set(BUILT_KEY, requested)
+                await async_redis_conn.set(VERSION_KEY, version)
+                await async_redis_conn.publish(VERSION_CHANNEL, version)
+                print(f"Knowledge base rebuilt, version {version}")
+                await asyncio.get_running_loop().run_in_executor(None, collect_garbage, version)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            try:
+                await lock.release()
+            except LockError:
+                pass
+
+    @staticmethod
+    async def refresh_links(link_ids):
+        from .genie import Genie
+        link_ids = list(link_ids)
+        try:
+            urls = await database_sync_to_async(link_cache.refresh)(link_ids)
+        except Exception:
+            traceback.print_exc()
+            return
+        # The galleries' links too, which answers show next to the residencies
+        links = Genie.current.residency_index.links if Genie.current is not None else {}
+        for link_id in link_ids:
+            if link_id not in links:
+                continue
+            if link_id in urls:
+                links[link_id]['url'] = urls[link_id]
+            else:
+                del links[link_id]
+
+    def ensure_reload(self, version):
+        """Reloads onto the version, one reload at a time, so an older build can't be swapped in after a newer one."""
+        self.version = version
+        if self.reload_task is None or self.reload_task.done():
+            self.reload_task = asyncio.get_running_loop().create_task(self.reload())
+
+    async def reload(self):
+        from .genie import Genie
+        while Genie.current is None or Genie.current.index_version != self.version:
+            if Genie.warm_up_task is not None and not Genie.warm_up_task.done():
+                # It may have read the version before it was published, so check again once it's done
+                await asyncio.shield(Genie.warm_up_task)
+                continue
+            version = self.version
+            await Genie.start_warm_up()
+            if self.version == version:
+                # Built on what was published by then (or failed), a newer version comes with a message of its own
+                break
+
+
+reloader = Reloader()
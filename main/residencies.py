@@ -0,0 +1,101 @@
+import pickle
+import re
+
+from chatbot.utils import fold_text
+
+RESIDENCY_INDEX_NAME = 'residency_index.pkl'
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class ResidencyIndex:
+    """
+    Finds the link a residency name belongs to without scanning the texts: every line of the pre-split
+    texts is folded, posted under its character trigrams and paired with the link on it (or on the line
+    before or after it). Names that were looked up once are remembered.
+    """
+
+    def __init__(self, lines, line_links):
+        self.lines = lines
+        self.line_links = line_links
+        self.postings = {}
+        for i, line in enumerate(lines):
+            if line_links[i] is not None:
+                for trigram in trigrams(line):
+                    self.postings.setdefault(trigram, set()).add(i)
+        self.names = {}
+        self.links = {}
+        self.images_updated_at = None
+
+    @classmethod
+    def build(cls, texts):
+        from .models import LINK_REGEX
+        raw_lines = [line for chunk in texts for line in chunk.page_content.split('\n')]
+        own_links = []
+        for line in raw_lines:
+            match = re.search(LINK_REGEX, line)
+            own_links.append(int(match.group(1)) if match else None)
+
+        line_links = []
+        for i, link_id in enumerate(own_links):
+            for j in (i - 1, i + 1):
+                if link_id is None and 0 <= j < len(own_links):
+                    link_id = own_links[j]
+            line_links.append(link_id)
+        return cls([fold_text(line) for line in raw_lines], line_links)
+
+    @staticmethod
+    def load(path):
+        """Loads the residency index kept in an index version directory."""
+        with open(path / RESIDENCY_INDEX_NAME, 'rb') as f:
+            return pickle.load(f)
+
+    def __getstate__(self):
+        # Link data comes from the database, and what was looked up is only valid for this process
+        return {'lines': self.lines, 'line_links': self.line_links, 'postings': self.postings}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, names={}, links={}, images_updated_at=None)
+
+    @staticmethod
+    def split_images(img_links):
+        # None means the gallery hasn't been scraped yet
+        return None if img_links is None else [img for img in img_links.split(',') if img]
+
+    def load_links(self):
+        from .models import Link
+        links = Link.objects.filter(pk__in={link_id for link_id in self.line_links if link_id is not None})
+        self.links = {link.pk: {'url': link.url, 'images': self.split_images(link.img_links)} for link in links}
+        self.images_updated_at = max((link.img_links_updated_at for link in links if link.img_links_updated_at), default=None)
+
+    def refresh_images(self):
+        """Picks up galleries scraped (or re-scraped) by any worker since the last refresh."""
+        from .models import Link
+        links = Link.objects.filter(pk__in=list(self.links), img_links__isnull=False)
+        if self.images_updated_at is not None:
+            # Inclusive, as another gallery may have been saved with the same timestamp
+            links = links.filter(img_links_updated_at__gte=self.images_updated_at)
+        for link_id, img_links, updated_at in links.values_list('pk', 'img_links', 'img_links_updated_at'):
+            self.links[link_id]['images'] = self.split_images(img_links)
+            if updated_at and (self.images_updated_at is None or updated_at > self.images_updated_at):
+                self.images_updated_at = updated_at
+
+    def find(self, name):
+        """Returns the id of the link of the first line mentioning the name, or None."""
+        name = fold_text(name.strip())
+        if name not in self.names:
+            self.names[name] = self.search(name)
+        return self.names[name]
+
+    def search(self, name):
+        if len(name) < 3:
+            candidates = range(len(self.lines))
+        else:
+            postings = sorted((self.postings.get(trigram, set()) for trigram in trigrams(name)), key=len)
+            candidates = sorted(set.intersection(*postings))
+        for i in candidates:
+            if self.line_links[i] is not None and name in self.lines[i]:
+                return self.line_links[i]
+        return None
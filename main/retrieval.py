@@ -0,0 +1,145 @@
+import heapq
+import math
+import re
+from collections import Counter
+from typing import Any, Optional
+from urllib.parse import urlparse
+
+from langchain.schema import BaseRetriever
+from langchain.vectorstores.base import VectorStore
+from pydantic import BaseModel
+
+from chatbot.utils import normalize_question
+
+from .context import build_context
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60
+# Chunks of the residencies named in the question count this many times as much as a place in the other rankings
+EXACT_WEIGHT = 2
+# Shorter slugs are too likely to be ordinary words
+MIN_NAME_LENGTH = 5
+
+
+def tokenize(text):
+    return normalize_question(text).split()
+
+
+def residency_name(url):
+    """The name a residency page is about, from the last part of its path, e.g. "vila marija" for .../vila-marija/."""
+    slug = urlparse(url).path.rstrip('/').rsplit('/', 1)[-1]
+    return normalize_question(re.sub(r'\.\w+$', '', slug).replace('-', ' ').replace('_', ' '))
+
+
+class LexicalIndex:
+    """
+    BM25 over the chunks, plus the residency names of the links in them, so a question naming a residency
+    finds its chunks. Only links whose name the text itself uses next to them count as residencies, and only
+    if most chunks mentioning the name link to it, which leaves out pages like .../kontakt/ whose slug is a
+    word used all over the texts.
+    """
+
+    def __init__(self, texts, link_urls):
+        from .models import LINK_REGEX
+        self.postings = {}
+        self.lengths = []
+        link_chunks = {}
+        for i, text in enumerate(texts):
+            terms = tokenize(text)
+            self.lengths.append(len(terms))
+            for term, tf in Counter(terms).items():
+                self.postings.setdefault(term, []).append((i, tf))
+            for link_id in dict.fromkeys(int(link_id) for link_id in re.findall(LINK_REGEX, text)):
+                link_chunks.setdefault(link_id, []).append(i)
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+
+        candidates = {}
+        for link_id, chunks in link_chunks.items():
+            name = residency_name(link_urls.get(link_id, ''))
+            if len(name) >= MIN_NAME_LENGTH:
+                candidates.setdefault(name, []).extend(chunks)
+        mentions = {}
+        regex = self.compile(candidates)
+        if regex is not None:
+            for i, text in enumerate(texts):
+                for name in set(regex.findall(normalize_question(re.sub(LINK_REGEX, ' ', text)))):
+                    mentions.setdefault(name, set()).add(i)
+        self.name_chunks = {
+            name: chunks for name, chunks in candidates.items()
+            if len(mentions.get(name, set()) & set(chunks)) * 2 >= len(mentions.get(name, ())) > 0
+        }
+        self.names_regex = self.compile(self.name_chunks)
+
+    @staticmethod
+    def compile(names):
+        # Longest first, so "vila marija lux" wins over "vila marija"
+        names = sorted(names, key=len, reverse=True)
+        return re.compile(r'\b(?:%s)\b' % '|'.join(map(re.escape, names))) if names else None
+
+    @classmethod
+    def build(cls, vectorstore, link_urls):
+        return cls([vectorstore.chunk(i).page_content for i in range(len(vectorstore))], link_urls)
+
+    def names(self, query):
+        """The residencies named in the query, in the order they are named."""
+        if self.names_regex is None:
+            return []
+        return list(dict.fromkeys(self.names_regex.findall(normalize_question(query))))
+
+    def exact(self, query):
+        """Chunks of the residencies named in the query, in the order they are named."""
+        return list(dict.fromkeys(i for name in self.names(query) for i in self.name_chunks[name]))
+
+    def search(self, query, n):
+        scores = Counter()
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (len(self.lengths) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for i, tf in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[i] / self.average_length)
+                scores[i] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return heapq.nlargest(n, scores, key=scores.get)
+
+
+def reciprocal_rank_fusion(*rankings, weights=None):
+    scores = Counter()
+    for ranking, weight in zip(rankings, weights or [1] * len(rankings)):
+        for rank, i in enumerate(ranking):
+            scores[i] += weight / (RRF_K + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class HybridRetriever(BaseRetriever, BaseModel):
+    """
+    Fuses the vector and BM25 rankings by reciprocal rank, together with the chunks of the residencies named
+    in the question, which weigh more. search_kwargs takes k, like the vector store retriever.
+    Given a token budget (and the encoding to count with), the chunks are assembled with build_context.
+    """
+    vectorstore: VectorStore
+    lexical: LexicalIndex
+    search_kwargs: dict = {'k': 4}
+    fetch_k: int = 20
+    max_tokens: Optional[int] = None
+    encoding: Any = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def fuse(self, query, embedding):
+        ranked = reciprocal_rank_fusion(
+            self.lexical.exact(query)[:self.fetch_k], self.vectorstore.rank(embedding, self.fetch_k),
+            self.lexical.search(query, self.fetch_k), weights=[EXACT_WEIGHT, 1, 1],
+        )
+        return [self.vectorstore.chunk(i) for i in ranked[:self.search_kwargs.get('k', 4)]]
+
+    def assemble(self, docs):
+        return docs if self.max_tokens is None else build_context(docs, self.max_tokens, self.encoding)
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        return self.assemble(self.fuse(query, self.vectorstore.embedding.embed_query(query)))
+
+    async def _aget_relevant_documents(self, query, *, run_manager=None):
+        return self.assemble(self.fuse(query, await self.vectorstore.embedding.aembed_query(query)))
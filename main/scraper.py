@@ -0,0 +1,171 @@
+import asyncio
+import math
+import traceback
+from datetime import timedelta
+
+import aiohttp
+from bs4 import BeautifulSoup
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .redis_init import async_redis_conn, blocking_redis_conn
+
+QUEUE_KEY = 'galleries:queue'
+PENDING_KEY = 'galleries:pending:%i'
+PENDING_TIMEOUT = 10 * 60
+FAILURES_KEY = 'galleries:failures:%i'
+# A gallery that failed to scrape isn't retried for this long, doubling with every further failure up to a day
+FAILURE_BACKOFF = 5 * 60
+MAX_FAILURE_BACKOFF = 24 * 60 * 60
+REFRESH_LOCK_KEY = 'galleries:refresh'
+
+
+def parse_gallery(html):
+    soup = BeautifulSoup(html, 'html.parser')
+
+    # Look for div elements with "gallery" in class
+    gallery_elements = soup.find_all(lambda tag: tag.name == 'div' and 'gallery__full-image' in tag.get('class', []))
+
+    img_links = set()
+    for element in gallery_elements:
+        # Look for img tags within those elements and extract the 'src' attribute
+        for img in element.find_all('img'):
+            val = img.get('src') or img.get('data-src')
+            if val:
+                img_links.add(val)
+    return list(img_links)
+
+
+@database_sync_to_async
+def get_link_url(link_id):
+    from .models import Link
+    return Link.objects.filter(pk=link_id).values_list('url', flat=True).first()
+
+
+@database_sync_to_async
+def save_img_links(link_id, img_links):
+    from .models import Link
+    Link.objects.filter(pk=link_id).update(img_links=','.join(img_links), img_links_updated_at=timezone.now())
+
+
+@database_sync_to_async
+def get_stale_link_ids():
+    from .models import Link
+    stale_before = timezone.now() - timedelta(days=settings.GALLERY_MAX_AGE_DAYS)
+    return list(Link.objects.filter(Q(img_links_updated_at__isnull=True) | Q(img_links_updated_at__lt=stale_before))
+                .values_list('pk', flat=True))
+
+
+class GalleryScraper:
+    """
+    Scrapes residency galleries off the answer path. Link ids are queued in Redis, so whichever worker is
+    free picks them up, and pages are fetched through one pooled client limited per host.
+    """
+
+    def __init__(self):
+        self.session = None
+        self.worker = None
+        self.tasks = set()
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=settings.GALLERY_SCRAPER_CONCURRENCY,
+                    limit_per_host=settings.GALLERY_SCRAPER_PER_HOST,
+                ),
+                timeout=aiohttp.ClientTimeout(total=30),
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def enqueue(self, *link_ids):
+        for link_id in link_ids:
+            # Keeps a link from being queued again until it has been scraped (or its worker has died)
+            if await async_redis_conn.set(PENDING_KEY % link_id, 1, nx=True, ex=PENDING_TIMEOUT):
+                await async_redis_conn.lpush(QUEUE_KEY, link_id)
+        self.ensure_worker()
+
+    def ensure_worker(self):
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        slots = asyncio.Semaphore(settings.GALLERY_SCRAPER_CONCURRENCY)
+        loop = asyncio.get_running_loop()
+        # By the clock rather than when the queue runs dry, which it may not for a while
+        refresh_at = loop.time() + settings.GALLERY_REFRESH_INTERVAL
+        while True:
+            if loop.time() >= refresh_at:
+                try:
+                    await self.refresh()
+                except Exception:
+                    traceback.print_exc()
+                refresh_at = loop.time() + settings.GALLERY_REFRESH_INTERVAL
+            await slots.acquire()
+            try:
+                item = await blocking_redis_conn.brpop(QUEUE_KEY, timeout=max(1, math.ceil(refresh_at - loop.time())))
+            except Exception:
+                traceback.print_exc()
+                item = None
+                await asyncio.sleep(settings.GALLERY_REFRESH_INTERVAL)
+            if item is None:
+                slots.release()
+                continue
+            # Kept referenced until it's done, so it isn't garbage collected mid-scrape
+            task = asyncio.create_task(self.process(int(item[1]), slots))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def process(self, link_id, slots):
+        try:
+            img_links = await self.scrape(link_id)
+            if img_links is not None:
+                self.update_index(link_id, img_links)
+            await async_redis_conn.delete(PENDING_KEY % link_id, FAILURES_KEY % link_id)
+        except Exception:
+            traceback.print_exc()
+            await self.back_off(link_id)
+        finally:
+            slots.release()
+
+    @staticmethod
+    async def back_off(link_id):
+        # The pending key stays until the backoff is over, so answers mentioning the residency don't queue it again
+        failures = await async_redis_conn.incr(FAILURES_KEY % link_id)
+        await async_redis_conn.expire(FAILURES_KEY % link_id, MAX_FAILURE_BACKOFF * 2)
+        await async_redis_conn.set(PENDING_KEY % link_id, 1, ex=min(FAILURE_BACKOFF * 2 ** (failures - 1), MAX_FAILURE_BACKOFF))
+
+    async def scrape(self, link_id):
+        url = await get_link_url(link_id)
+        if url is None:
+            return None
+        async with self.get_session().get(url) as response:
+            response.raise_for_status()
+            html = await response.text()
+        img_links = await asyncio.get_running_loop().run_in_executor(None, parse_gallery, html)
+        await save_img_links(link_id, img_links)
+        return img_links
+
+    @staticmethod
+    def update_index(link_id, img_links):
+        from .genie import Genie
+        if Genie.current is not None and link_id in Genie.current.residency_index.links:
+            Genie.current.residency_index.links[link_id]['images'] = img_links
+
+    async def refresh(self):
+        from .genie import Genie
+        # Pick up galleries scraped by other workers
+        if Genie.current is not None:
+            await database_sync_to_async(Genie.current.residency_index.refresh_images)()
+        # Only one worker per interval looks for galleries that are due for a refresh
+        if await async_redis_conn.set(REFRESH_LOCK_KEY, 1, nx=True, ex=settings.GALLERY_STALE_CHECK_INTERVAL):
+            await self.enqueue(*await get_stale_link_ids())
+
+
+gallery_scraper = GalleryScraper()
@@ -0,0 +1,64 @@
+from datetime import date
+
+import msgpack
+import orjson
+
+
+def dumps(obj):
+    return orjson.dumps(obj).decode()
+
+
+def loads(data):
+    return orjson.loads(data)
+
+
+def msgpack_default(obj):
+    # orjson's format, so the panel parses dates the same either way
+    if isinstance(obj, date):
+        return obj.isoformat()
+    raise TypeError(f'Object of type {type(obj).__name__} is not serializable')
+
+
+class JSONCodec:
+    name = 'json'
+    subprotocol = None
+    binary = False
+
+    @staticmethod
+    def encode(obj):
+        return dumps(obj)
+
+    @staticmethod
+    def decode(data):
+        return loads(data)
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+    subprotocol = 'msgpack'
+    binary = True
+
+    @staticmethod
+    def encode(obj):
+        return msgpack.packb(obj, default=msgpack_default)
+
+    @staticmethod
+    def decode(data):
+        return msgpack.unpackb(data)
+
+
+CODECS = [JSONCodec, MsgpackCodec]
+
+
+def negotiate(subprotocols):
+    """Picks the first codec whose subprotocol the client offered, or JSON."""
+    for subprotocol in subprotocols:
+        for codec in CODECS:
+            if codec.subprotocol == subprotocol:
+                return codec
+    return JSONCodec
+
+
+def encode_all(obj):
+    """Encodes an event in every format once, so it can be sent as is to every recipient."""
+    return {codec.name: codec.encode(obj) for codec in CODECS}
@@ -1,38 +1,33 @@
-from channels.layers import get_channel_layer
+from django.db import transaction
 from django.dispatch import receiver
-from django.db.models.signals import post_save
-from asgiref.sync import async_to_sync
-from .models import ChatMessage, ChatSession
-
-@receiver(post_save, sender=ChatMessage)
-def new_message(sender, instance, created, **kwargs):
-    if created and instance.message:
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            'panel',
-            {
-                'type': 'chat_message',
-                'command': 'new_message',
-                'message': {
-                    'id': instance.id,
-                    'message': instance.message,
-                    'response': instance.response,
-                    'file': instance.file.name,
-                    'session_id': instance.session_id,
-                    'session_name': instance.session.name
-                },
-            }
-        )
+from django.db.models.signals import post_save, post_delete
+from .links import link_cache, publish_changes
+from .panel_events import panel_event_bus
+from .models import ChatSession, Document, Link
+from .reload import request_rebuild
 
 @receiver(post_save, sender=ChatSession)
 def new_session(sender, instance, created, **kwargs):
     if created:
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            'panel',
-            {
-                'type': 'chat_session',
-                'command': 'new_session',
-                'session': instance.to_dict(),
-            }
-        )
+        panel_event_bus.publish_threadsafe({
+            'command': 'new_session',
+            'session': instance.to_dict(),
+        })
+
+@receiver(post_save, sender=Link)
+def link_saved(sender, instance, **kwargs):
+    link_cache.urls[instance.pk] = instance.url
+    transaction.on_commit(lambda: publish_changes([instance.pk]))
+
+@receiver(post_delete, sender=Link)
+def link_deleted(sender, instance, **kwargs):
+    link_cache.urls.pop(instance.pk, None)
+    link_id = instance.pk
+    transaction.on_commit(lambda: publish_changes([link_id]))
+
+@receiver(post_save, sender=Document)
+@receiver(post_delete, sender=Document)
+def document_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        # Once committed, so the rebuild sees the change, and not at all if it's rolled back
+        transaction.on_commit(request_rebuild)
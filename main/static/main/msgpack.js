@@ -0,0 +1,87 @@
+// A msgpack decoder for the panel's websocket frames, served from here rather than a CDN. It covers everything
+// the server's msgpack.packb produces (nil, booleans, integers, floats, strings, binary, arrays and maps), and
+// throws on extension types, which the server never sends.
+(function (global) {
+    'use strict';
+
+    var textDecoder = new TextDecoder();
+
+    function decode(bytes) {
+        var view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        var pos = 0;
+
+        function uint8() { return view.getUint8(pos++); }
+        function uint16() { var value = view.getUint16(pos); pos += 2; return value; }
+        function uint32() { var value = view.getUint32(pos); pos += 4; return value; }
+
+        function str(length) {
+            var value = textDecoder.decode(bytes.subarray(pos, pos + length));
+            pos += length;
+            return value;
+        }
+
+        function bin(length) {
+            var value = bytes.slice(pos, pos + length);
+            pos += length;
+            return value;
+        }
+
+        function array(length) {
+            var value = new Array(length);
+            for (var i = 0; i < length; i++) {
+                value[i] = read();
+            }
+            return value;
+        }
+
+        function map(length) {
+            var value = {};
+            for (var i = 0; i < length; i++) {
+                var key = read();
+                value[key] = read();
+            }
+            return value;
+        }
+
+        function read() {
+            var type = uint8();
+            var value;
+            if (type < 0x80) return type;
+            if (type < 0x90) return map(type & 0x0f);
+            if (type < 0xa0) return array(type & 0x0f);
+            if (type < 0xc0) return str(type & 0x1f);
+            if (type >= 0xe0) return type - 0x100;
+            switch (type) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: return bin(uint8());
+                case 0xc5: return bin(uint16());
+                case 0xc6: return bin(uint32());
+                case 0xca: value = view.getFloat32(pos); pos += 4; return value;
+                case 0xcb: value = view.getFloat64(pos); pos += 8; return value;
+                case 0xcc: return uint8();
+                case 0xcd: return uint16();
+                case 0xce: return uint32();
+                // 64 bit integers lose precision past 2^53, like they would in JSON
+                case 0xcf: value = uint32() * 0x100000000; return value + uint32();
+                case 0xd0: value = view.getInt8(pos); pos += 1; return value;
+                case 0xd1: value = view.getInt16(pos); pos += 2; return value;
+                case 0xd2: value = view.getInt32(pos); pos += 4; return value;
+                case 0xd3: value = view.getInt32(pos) * 0x100000000; pos += 4; return value + uint32();
+                case 0xd9: return str(uint8());
+                case 0xda: return str(uint16());
+                case 0xdb: return str(uint32());
+                case 0xdc: return array(uint16());
+                case 0xdd: return array(uint32());
+                case 0xde: return map(uint16());
+                case 0xdf: return map(uint32());
+            }
+            throw new Error('Unsupported msgpack type 0x' + type.toString(16));
+        }
+
+        return read();
+    }
+
+    global.MessagePack = { decode: decode };
+})(window);
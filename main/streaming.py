@@ -0,0 +1,81 @@
+import json
+import re
+from functools import lru_cache
+
+ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+ANSWER_START_REGEX = re.compile(r'"answer"\s*:\s*"')
+
+
+@lru_cache(maxsize=None)
+def partial_placeholder_regex():
+    """Matches the end of a text if it could still grow into a link placeholder, e.g. "lin" or "link://1"."""
+    from .models import LINK_PLACEHOLDER
+    pattern = r'\d*'
+    for c in reversed(LINK_PLACEHOLDER.replace('%i', '')):
+        pattern = f'{re.escape(c)}(?:{pattern})?'
+    return re.compile(pattern + '$')
+
+
+class PartialAnswerParser:
+    """Pulls the value of the "answer" field out of function call arguments while they are being streamed."""
+
+    def __init__(self):
+        self.arguments = ''
+        self.pos = None
+        self.done = False
+
+    def feed(self, chunk):
+        """Adds a piece of the arguments and returns the newly decoded part of the answer."""
+        self.arguments += chunk
+        if self.done:
+            return ''
+        if self.pos is None:
+            match = ANSWER_START_REGEX.search(self.arguments)
+            if not match:
+                return ''
+            self.pos = match.end()
+
+        decoded = []
+        buf, i = self.arguments, self.pos
+        while i < len(buf):
+            c = buf[i]
+            if c == '"':
+                self.done = True
+                break
+            if c == '\\':
+                if i + 1 >= len(buf):
+                    break
+                if buf[i + 1] != 'u':
+                    decoded.append(ESCAPES.get(buf[i + 1], buf[i + 1]))
+                    i += 2
+                    continue
+                # \uXXXX, or two of them for characters outside the BMP
+                length = 12 if 0xd800 <= int(buf[i + 2:i + 6] or '0', 16) <= 0xdbff else 6
+                if i + length > len(buf):
+                    break
+                decoded.append(json.loads(f'"{buf[i:i + length]}"'))
+                i += length
+                continue
+            decoded.append(c)
+            i += 1
+        self.pos = i
+        return ''.join(decoded)
+
+
+class LinkStream:
+    """Resolves link placeholders in streamed text, holding back anything that may be an unfinished one."""
+
+    def __init__(self, resolve):
+        self.resolve = resolve
+        self.pending = ''
+
+    def feed(self, text):
+        self.pending += text
+        match = partial_placeholder_regex().search(self.pending)
+        cut = match.start() if match else len(self.pending)
+        ready, self.pending = self.pending[:cut], self.pending[cut:]
+        return self.resolve(ready)
+
+    def flush(self):
+        ready, self.pending = self.pending, ''
+        return self.resolve(ready)
@@ -1,3 +1,407 @@
-from django.test import TestCase
+import pickle
+import re
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, override_settings
+from langchain.docstore.document import Document as LCDocument
+
+from .cache import AnswerCache, VectorMirror
+from .consumers import PANEL_PAGE_SIZE, PanelConsumer
+from .costs import CACHE_ONLY, ECONOMY, MICROS, NORMAL, budget_limit_micros, cost_micros, spend_mode
+from .context import build_context, merge_overlapping
+from .intents import IntentMatcher, intent_matcher
+from .models import LINK_PLACEHOLDER, LINK_REGEX, ChatMessage, ChatSession, Document, Link
+from .residencies import ResidencyIndex
+from .retrieval import LexicalIndex, reciprocal_rank_fusion
+from .streaming import LinkStream, PartialAnswerParser
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class AddMessageTests(TestCase):
+    def setUp(self):
+        self.session = ChatSession.objects.create(sid='test')
+
+    def test_query_count(self):
+        # SAVEPOINT, INSERT of the message, UPDATE of last_message_id, SELECT of the name, RELEASE SAVEPOINT
+        with self.assertNumQueries(5):
+            chat_message = self.session.add_message('Pitanje', 'Odgovor')
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.last_message_id, chat_message.pk)
+
+    def test_reads_the_current_name(self):
+        ChatSession.objects.filter(pk=self.session.pk).update(name='Vila Marija')
+        self.session.add_message('Pitanje', 'Odgovor')
+        self.assertEqual(self.session.name, 'Vila Marija')
+
+    def test_keeps_other_fields(self):
+        ChatSession.objects.filter(pk=self.session.pk).update(is_human_intercepted=True)
+        self.session.add_message('Pitanje', None)
+        self.session.refresh_from_db()
+        self.assertTrue(self.session.is_human_intercepted)
+
+
+@mock.patch('main.models.publish_changes')
+class ExtractLinksTests(TestCase):
+    URL = 'https://example.com/vila-marija/'
+    OTHER_URL = 'https://example.com/apartman-sunce/'
+
+    def setUp(self):
+        self.document = Document.objects.create(name='Vile', doc_file='documents/vile.txt', doc_type='txt')
+
+    def docs(self, *texts):
+        return [LCDocument(page_content=text) for text in texts]
+
+    def test_replaces_urls_with_placeholders(self, publish_changes):
+        with self.assertNumQueries(2):
+            docs = self.document.extract_links(self.docs(f'Vila Marija {self.URL}', f'Opet {self.URL} i {self.OTHER_URL}'))
+        links = dict(Link.objects.values_list('url', 'pk'))
+        self.assertEqual(len(links), 2)
+        self.assertEqual(docs[0].page_content, f'Vila Marija {LINK_PLACEHOLDER % links[self.URL]}')
+        self.assertEqual(
+            docs[1].page_content, f'Opet {LINK_PLACEHOLDER % links[self.URL]} i {LINK_PLACEHOLDER % links[self.OTHER_URL]}'
+        )
+        publish_changes.assert_called_once_with(sorted(links.values()))
+
+    def test_keeps_ids_when_ingested_again(self, publish_changes):
+        first = self.document.extract_links(self.docs(self.URL))[0].page_content
+        with self.assertNumQueries(1):
+            second = self.document.extract_links(self.docs(self.URL))[0].page_content
+        self.assertEqual(first, second)
+        self.assertEqual(Link.objects.count(), 1)
+        publish_changes.assert_called_with([])
+
+    def test_shares_links_across_documents(self, publish_changes):
+        other = Document.objects.create(name='Apartmani', doc_file='documents/apartmani.txt', doc_type='txt')
+        first = self.document.extract_links(self.docs(self.URL))[0].page_content
+        self.assertEqual(other.extract_links(self.docs(self.URL))[0].page_content, first)
+        self.assertEqual(Link.objects.get().document, self.document)
+
+    def test_oldest_duplicate_wins(self, publish_changes):
+        oldest = Link.objects.create(url=self.URL)
+        Link.objects.create(url=self.URL)
+        self.assertEqual(self.document.extract_links(self.docs(self.URL))[0].page_content, LINK_PLACEHOLDER % oldest.pk)
+
+    def test_links_outlive_their_document(self, publish_changes):
+        other = Document.objects.create(name='Apartmani', doc_file='documents/apartmani.txt', doc_type='txt')
+        self.document.extract_links(self.docs(self.URL))
+        text = other.extract_links(self.docs(self.URL))[0].page_content
+        self.document.delete()
+        link = Link.objects.get()
+        self.assertIsNone(link.document)
+        self.assertEqual(text, LINK_PLACEHOLDER % link.pk)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class PanelPaginationTests(TestCase):
+    def setUp(self):
+        self.consumer = PanelConsumer()
+        self.consumer.scope = {'user': User.objects.create(username='agent')}
+        self.session = ChatSession.objects.create(sid='test')
+        ChatMessage.objects.bulk_create(
+            ChatMessage(session=self.session, message=f'Pitanje {i}') for i in range(PANEL_PAGE_SIZE * 2 + 5)
+        )
+        # Written in the same instant, so only the ids tell them apart
+        ChatMessage.objects.update(created_at=ChatMessage.objects.earliest('pk').created_at)
+        self.message_ids = list(ChatMessage.objects.order_by('pk').values_list('pk', flat=True))
+
+    def get_messages(self, before=None, since=None):
+        messages, has_more, _ = async_to_sync(self.consumer.get_messages)(self.session.pk, before, since)
+        return [message['id'] for message in messages], has_more
+
+    def test_pages_cover_every_message_once(self):
+        pages, before, has_more = [], None, True
+        while has_more:
+            page, has_more = self.get_messages(before)
+            self.assertEqual(page, sorted(page))
+            pages.append(page)
+            before = page[0]
+        self.assertEqual([len(page) for page in pages], [PANEL_PAGE_SIZE, PANEL_PAGE_SIZE, 5])
+        self.assertEqual([pk for page in reversed(pages) for pk in page], self.message_ids)
+
+    def test_full_last_page(self):
+        page, has_more = self.get_messages(self.message_ids[PANEL_PAGE_SIZE])
+        self.assertEqual(page, self.message_ids[:PANEL_PAGE_SIZE])
+        self.assertFalse(has_more)
+
+    def test_since(self):
+        since = self.message_ids[-PANEL_PAGE_SIZE - 3]
+        page, has_more = self.get_messages(since=since)
+        self.assertEqual(page, self.message_ids[-PANEL_PAGE_SIZE - 2:])
+        self.assertFalse(has_more)
+        self.assertEqual(self.get_messages(since=self.message_ids[-1]), ([], False))
+
+    def test_session_pages(self):
+        session_ids = [self.session.pk] + [
+            session.pk for session in ChatSession.objects.bulk_create(ChatSession(sid=f'test{i}') for i in range(PANEL_PAGE_SIZE))
+        ]
+        pages, before, has_more = [], None, True
+        while has_more:
+            sessions, has_more = async_to_sync(self.consumer.get_sessions)(before)
+            pages.append([session['id'] for session in sessions])
+            before = pages[-1][-1]
+        self.assertEqual([len(page) for page in pages], [PANEL_PAGE_SIZE, 1])
+        self.assertEqual([pk for page in pages for pk in page], session_ids[::-1])
+        # The first session is written to, so it comes back with the new one
+        message = self.session.add_message('Pitanje', None)
+        new_session = ChatSession.objects.create(sid='new')
+        sessions, _ = async_to_sync(self.consumer.get_sessions)(
+            since={'session': session_ids[-1], 'message': self.message_ids[-1]}
+        )
+        self.assertEqual([(session['id'], session['last_message_text']) for session in sessions], [
+            (self.session.pk, message.message), (new_session.pk, None),
+        ])
+
+
+class CostsTests(SimpleTestCase):
+    def test_cost_micros(self):
+        # 0.0015 and 0.002 USD per 1K tokens
+        self.assertEqual(cost_micros('gpt-3.5-turbo-0613', 1000, 1000), 3500)
+        self.assertEqual(cost_micros('gpt-4-0613', 1500, 500), 75000)
+        self.assertEqual(cost_micros('gpt-3.5-turbo-0613', 0, 0), 0)
+
+    def test_cost_micros_rounds_up(self):
+        # A single prompt token costs 1.5 micros
+        self.assertEqual(cost_micros('gpt-3.5-turbo-0613', 1, 0), 2)
+
+    @override_settings(MONTHLY_BUDGET_USD=10, BUDGET_ECONOMY_RATIO=0.8, BUDGET_CACHE_ONLY_RATIO=0.95)
+    def test_spend_mode(self):
+        self.assertEqual(spend_mode(0), NORMAL)
+        self.assertEqual(spend_mode(8 * MICROS - 1), NORMAL)
+        self.assertEqual(spend_mode(8 * MICROS), ECONOMY)
+        self.assertEqual(spend_mode(int(9.5 * MICROS) - 1), ECONOMY)
+        self.assertEqual(spend_mode(int(9.5 * MICROS)), CACHE_ONLY)
+        self.assertEqual(budget_limit_micros(), int(9.5 * MICROS))
+
+    @override_settings(MONTHLY_BUDGET_USD=0)
+    def test_spend_mode_without_a_budget(self):
+        self.assertEqual(spend_mode(100 * MICROS), NORMAL)
+        self.assertEqual(budget_limit_micros(), 0)
+
+
+class PartialAnswerParserTests(SimpleTestCase):
+    def feed(self, *chunks):
+        parser = PartialAnswerParser()
+        return [parser.feed(chunk) for chunk in chunks]
+
+    def test_one_character_at_a_time(self):
+        arguments = '{"answer": "Vila \\"Marija\\"\\nima bazen", "residencies": ["Vila Marija"]}'
+        self.assertEqual(''.join(self.feed(*arguments)), 'Vila "Marija"\nima bazen')
+
+    def test_waits_for_the_answer_field(self):
+        self.assertEqual(self.feed('{"resid', 'encies": [], "ans', 'wer": "Da"}'), ['', '', 'Da'])
+
+    def test_escape_split_across_chunks(self):
+        self.assertEqual(self.feed('{"answer": "a\\', 'tb"}'), ['a', '\tb'])
+
+    def test_unicode_escape_split_across_chunks(self):
+        self.assertEqual(self.feed('{"answer": "pra\\u01', '61anje"}'), ['pra', 'šanje'])
+
+    def test_surrogate_pair_split_across_chunks(self):
+        self.assertEqual(self.feed('{"answer": "ok \\ud83d', '\\ude00"}'), ['ok ', '\U0001f600'])
+
+    def test_ignores_what_comes_after_the_answer(self):
+        self.assertEqual(self.feed('{"answer": "Da", "residencies": ["', 'x"]}'), ['Da', ''])
+
+
+class LinkStreamTests(SimpleTestCase):
+    URLS = {12: 'https://example.com/vila-marija/'}
+
+    def setUp(self):
+        self.stream = LinkStream(lambda text: re.sub(LINK_REGEX, lambda match: self.URLS[int(match.group(1))], text))
+
+    def test_placeholder_split_across_deltas(self):
+        self.assertEqual(
+            [self.stream.feed(text) for text in ('Pogledajte lin', 'k://1', '2 ovde')],
+            ['Pogledajte ', '', 'https://example.com/vila-marija/ ovde'],
+        )
+        self.assertEqual(self.stream.flush(), '')
+
+    def test_placeholder_at_the_end(self):
+        self.assertEqual(self.stream.feed('Pogledajte link://12'), 'Pogledajte ')
+        self.assertEqual(self.stream.flush(), 'https://example.com/vila-marija/')
+
+    def test_text_that_only_looks_like_a_placeholder(self):
+        self.assertEqual(self.stream.feed('Bazen je li'), 'Bazen je ')
+        self.assertEqual(self.stream.feed('jep.'), 'lijep.')
+
+
+class ResidencyIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = ResidencyIndex.build([
+            LCDocument(page_content='Vila Marija\nlink://1\nBazen i parking'),
+            LCDocument(page_content='Apartmani Šumadija link://2\nCena: 50 EUR'),
+        ])
+
+    def test_name_on_the_line_of_the_link(self):
+        self.assertEqual(self.index.find('Apartmani Šumadija'), 2)
+
+    def test_name_on_the_line_next_to_the_link(self):
+        self.assertEqual(self.index.find('Vila Marija'), 1)
+
+    def test_folds_the_name(self):
+        self.assertEqual(self.index.find(' ВИЛА МАРИЈА '), 1)
+        self.assertEqual(self.index.find('sumadija'), 2)
+
+    def test_short_name(self):
+        self.assertEqual(self.index.find('Vi'), 1)
+
+    def test_unknown_name(self):
+        self.assertIsNone(self.index.find('Hotel Central'))
+        self.assertIn('hotel central', self.index.names)
+
+    def test_pickle_forgets_lookups(self):
+        self.index.find('Vila Marija')
+        index = pickle.loads(pickle.dumps(self.index))
+        self.assertEqual(index.names, {})
+        self.assertEqual(index.find('Vila Marija'), 1)
+
+
+class IntentMatcherTests(SimpleTestCase):
+    def test_contact_an_agent(self):
+        self.assertEqual(intent_matcher.detect('Sakam da kontaktiram agent'), {'contact', 'agent'})
+
+    def test_cyrillic(self):
+        self.assertEqual(intent_matcher.detect('Можам ли да зборувам со човек?'), {'contact', 'agent'})
+
+    def test_misspelled(self):
+        self.assertEqual(intent_matcher.detect('kontaktirat agentaa'), {'contact', 'agent'})
+
+    def test_one_intent(self):
+        self.assertEqual(intent_matcher.detect('Koj e agentot?'), {'agent'})
+
+    def test_unrelated(self):
+        self.assertEqual(intent_matcher.detect('Koliko košta noćenje u vili?'), set())
+        self.assertEqual(intent_matcher.detect(''), set())
+
+    def test_threshold(self):
+        matcher = IntentMatcher()
+        matcher.register('pool', ['bazen'], threshold=0.5)
+        self.assertEqual(matcher.detect('bazen'), {'pool'})
+        self.assertEqual(matcher.detect('Ima li bazen u vili?'), set())
+        self.assertEqual(matcher.scores('parking'), {'pool': 0})
+
+
+class ReciprocalRankFusionTests(SimpleTestCase):
+    def test_agreement_wins(self):
+        self.assertEqual(reciprocal_rank_fusion([1, 2, 3], [2, 3, 1], [2, 1, 3]), [2, 1, 3])
+
+    def test_weights(self):
+        self.assertEqual(reciprocal_rank_fusion([1], [2], [2]), [2, 1])
+        self.assertEqual(reciprocal_rank_fusion([1], [2], [2], weights=[3, 1, 1]), [1, 2])
+
+    def test_empty_rankings(self):
+        self.assertEqual(reciprocal_rank_fusion([], [4, 5], weights=[2, 1]), [4, 5])
+
+
+class LexicalIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = LexicalIndex([
+            'Vila Marija link://1 ima bazen',
+            'U vili Marija je i parking, link://1',
+            'Vila Marija Lux link://4 je nova',
+            'Za kontakt link://2 pišite nam',
+            'Kontakt telefon je na sajtu',
+            'Kontakt i rezervacije svaki dan',
+            'Apartman link://3 je blizu mora',
+        ], {
+            1: 'https://example.com/vila-marija/',
+            2: 'https://example.com/kontakt/',
+            3: 'https://example.com/apartman-sunce/',
+            4: 'https://example.com/vila-marija-lux/',
+        })
+
+    def test_names(self):
+        self.assertEqual(self.index.names('Da li Vila Marija ima bazen?'), ['vila marija'])
+        self.assertEqual(self.index.names('Vila Marija Lux ili Vila Marija?'), ['vila marija lux', 'vila marija'])
+
+    def test_leaves_out_common_words(self):
+        # Most chunks mentioning "kontakt" don't link to the contact page
+        self.assertEqual(self.index.names('Kontakt za Vilu Mariju'), [])
+
+    def test_leaves_out_names_the_texts_dont_use(self):
+        self.assertEqual(self.index.names('Apartman Sunce'), [])
+
+    def test_exact(self):
+        self.assertEqual(self.index.exact('vila marija'), [0, 1])
+        self.assertEqual(self.index.exact('parking'), [])
+
+    def test_search(self):
+        self.assertEqual(self.index.search('Da li postoji parking?', 1), [1])
+        self.assertEqual(self.index.search('sauna', 3), [])
+
+
+class WordEncoding:
+    """Counts words as tokens, so budgets are easy to follow."""
+
+    @staticmethod
+    def encode(text):
+        return text.split()
+
+
+class ContextTests(SimpleTestCase):
+    SHARED = 'Sobe su klimatizovane i imaju sopstveno kupatilo sa tušem.'
+
+    def doc(self, text, document_id=1):
+        return LCDocument(page_content=text, metadata={'document_id': document_id})
+
+    def test_merges_overlapping_chunks(self):
+        first = self.doc('Vila Marija je u centru. ' + self.SHARED)
+        second = self.doc(self.SHARED + ' Cena je 50 EUR.')
+        other = self.doc('Apartman Sunce je blizu mora.', 2)
+        merged = merge_overlapping([second, other, first])
+        self.assertEqual(
+            [doc.page_content for doc in merged],
+            ['Vila Marija je u centru. ' + self.SHARED + ' Cena je 50 EUR.', 'Apartman Sunce je blizu mora.'],
+        )
+
+    def test_keeps_chunks_of_other_documents(self):
+        docs = [self.doc('Uvod. ' + self.SHARED), self.doc(self.SHARED + ' Kraj.', 2)]
+        self.assertEqual(merge_overlapping(docs), docs)
+
+    def test_keeps_short_overlaps(self):
+        docs = [self.doc('Vila Marija ima bazen.'), self.doc('ima bazen. I parking.')]
+        self.assertEqual(merge_overlapping(docs), docs)
+
+    def test_drops_repeated_lines(self):
+        context = build_context([
+            self.doc('Vila Marija\nCena:\n' + self.SHARED),
+            self.doc('Apartman Sunce\nCena:\n' + self.SHARED, 2),
+        ], 100, WordEncoding())
+        self.assertEqual(
+            [doc.page_content for doc in context],
+            ['Vila Marija\nCena:\n' + self.SHARED, 'Apartman Sunce\nCena:'],
+        )
+
+    def test_cuts_chunks_at_the_first_line_that_doesnt_fit(self):
+        context = build_context([
+            self.doc('Vila Marija\n' + self.SHARED + '\nCena: 50 EUR'),
+            self.doc('Apartman Sunce', 2),
+        ], 8, WordEncoding())
+        self.assertEqual([doc.page_content for doc in context], ['Vila Marija', 'Apartman Sunce'])
+
+    def test_leaves_out_chunks_with_nothing_left(self):
+        context = build_context([self.doc(self.SHARED), self.doc(self.SHARED, 2)], 100, WordEncoding())
+        self.assertEqual(len(context), 1)
+
+
+class AnswerCacheTests(SimpleTestCase):
+    def test_most_similar_names_the_same_residencies(self):
+        mirror = VectorMirror('1')
+        mirror.vectors = {'a': np.array([1, 0], dtype=np.float32), 'b': np.array([0.99, 0.14], dtype=np.float32)}
+        mirror.names = {'a': 'vila marija', 'b': ''}
+        self.assertEqual(mirror.most_similar(np.array([1, 0], dtype=np.float32), 'vila marija'), 'a')
+        self.assertEqual(mirror.most_similar(np.array([1, 0], dtype=np.float32), ''), 'b')
+        self.assertIsNone(mirror.most_similar(np.array([0, 1], dtype=np.float32), ''))
+        mirror.forget('b')
+        self.assertIsNone(mirror.most_similar(np.array([1, 0], dtype=np.float32), ''))
+
+    def test_mirrors_the_latest_versions(self):
+        cache = AnswerCache()
+        previous = cache.mirror('1')
+        self.assertIs(cache.mirror('1'), previous)
+        cache.mirror('2')
+        cache.mirror('3')
+        self.assertEqual(list(cache.mirrors), ['2', '3'])
@@ -6,4 +6,5 @@ urlpatterns = [
     path('login/', views.login_view, name='login'),
     path('panel/', views.panel_view, name='panel'),
     path('upload/', views.upload, name='upload'),
+    path('health/', views.health, name='health'),
 ]
@@ -9,13 +9,22 @@ from django.shortcuts import render, redirect
 from django.views.decorators.csrf import ensure_csrf_cookie, csrf_exempt
 from django.views.decorators.http import require_http_methods
 
+from main.genie import Genie
 from main.models import ChatMessage, ChatSession
+from main.panel_events import panel_event_bus
 
 
 def chat_view(request):
     return render(request, 'chat.html', context={'HOSTNAME': settings.HOSTNAME, 'IS_HTTPS': settings.IS_HTTPS})
 
 
+def health(request):
+    return JsonResponse({
+        'state': Genie.state,
+        'index_version': Genie.current.index_version if Genie.current else None,
+    }, status=200 if Genie.state == Genie.READY else 503)
+
+
 @ensure_csrf_cookie
 def login_view(request):
     if request.method == 'POST':
@@ -56,8 +65,7 @@ def upload(request):
         'message': message,
         'file': chat_message.file.name,
     })
-    async_to_sync(channel_layer.group_send)('panel', {
-        'type': 'file_uploaded',
+    panel_event_bus.publish_threadsafe({
         'command': 'file_uploaded',
         'session_id': session.pk,
         'message': {
@@ -65,6 +73,6 @@ def upload(request):
             'response': message,
             'file': chat_message.file.name,
         }
-    })
+    }, session.pk)
 
     return JsonResponse({'filename': chat_message.filename})
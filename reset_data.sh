@@ -1,7 +1,8 @@
 #!/bin/bash
 
 # cd /var/www/chatbot/
-rm -rf media/chroma/ media/documents/*.pkl
+# Workers rebuild the knowledge base on their own when documents change, this is only for starting over.
+# Links and embeddings are reused on re-ingestion, so only the versions built from them need to go
+rm -rf media/index
 cd docker/prod
-docker-compose run --entrypoint "python manage.py shell -c 'from main.models import Link; Link.objects.all().delete()'" django
 docker-compose restart django